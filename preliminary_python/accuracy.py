@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""LigFit accuracy
+
+Measures the accuracy and speed of every way of evaluating the model against
+a reference of [P], [PL] and [PLP] computed at 120 digits over a wide grid of
+L_total, Kd, alpha and P_total (cached to disk once built), and recommends
+the cheapest precision mode that meets a tolerance within a region of the
+grid.
+
+Usage:
+  accuracy.py [--tolerance=<tol>] [--kd-range=<range>] [--alpha-range=<range>]
+              [--p-range=<range>] [--l-range=<range>] [--output=<json>]
+              [--rebuild]
+
+Options:
+  --tolerance=<tol>      largest acceptable relative error in any species
+                         [default: 1e-10]
+  --kd-range=<range>     log10 bounds of Kd in the region, as low,high
+  --alpha-range=<range>  log10 bounds of alpha in the region, as low,high
+  --p-range=<range>      log10 bounds of P_total in the region, as low,high
+  --l-range=<range>      log10 bounds of L_total in the region, as low,high
+  --output=<json>        write the report to a file instead of standard output
+  --rebuild              recompute the reference rather than load it
+  -h --help              show this help message and exit
+
+"""
+
+import json
+import os
+import time
+
+import numpy
+
+import ligfit
+
+REFERENCE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'accuracy_reference.npz')
+REFERENCE_DPS = 120
+
+#The reference grid in log10 units
+LOG_KD = numpy.linspace(-3.0, 3.0, 5)
+LOG_ALPHA = numpy.linspace(-2.0, 9.0, 6)
+LOG_P = numpy.linspace(-3.0, 2.0, 4)
+LOG_L = numpy.linspace(-4.0, 6.0, 11)
+
+SPECIES = ('p', 'pl', 'plp')
+
+MPMATH_DPS = (20, 30, 50)
+
+
+def reference_point(kd, alpha, p_total, l_total):
+    '''
+    Returns [P]-free, [PL] and [PLP] of one point as mpf at the working
+    precision: the closed form, refined by Newton steps on the cubic until
+    they stop changing it.
+    '''
+    import mpmath
+    kd, alpha, p_total, l_total = [mpmath.mpf(float(i)) for i in (kd, alpha, p_total, l_total)]
+    a, b, c = ligfit.calc_abc(kd, alpha, p_total, l_total)
+    q, r = ligfit.calc_qr(a, b, c)
+    p = ligfit.solve_cubic_mp(a, q, r)
+    for i in range(100):
+        step = (((p + a) * p + b) * p + c) / ((3 * p + 2 * a) * p + b)
+        p -= step
+        if abs(step) <= abs(p) * mpmath.eps:
+            break
+    return p, ligfit.get_pl(kd, alpha, l_total, p), ligfit.get_plp(kd, alpha, l_total, p)
+
+
+def build_reference(file_path=REFERENCE_PATH, dps=REFERENCE_DPS):
+    '''
+    Computes the reference over the whole grid and writes it, with the
+    species stored as decimal strings so that no digits are lost.
+    '''
+    import mpmath
+    grid = numpy.meshgrid(LOG_KD, LOG_ALPHA, LOG_P, LOG_L, indexing='ij')
+    kd, alpha, p_total, l_total = [numpy.power(10.0, i.ravel()) for i in grid]
+    values = []
+    with mpmath.workdps(dps):
+        for point in zip(kd, alpha, p_total, l_total):
+            values.append([mpmath.nstr(i, dps, min_fixed=1, max_fixed=0) for i in reference_point(*point)])
+    values = numpy.array(values)
+    numpy.savez_compressed(file_path, kd=kd, alpha=alpha, p_total=p_total, l_total=l_total,
+                           p=values[:, 0], pl=values[:, 1], plp=values[:, 2], dps=dps)
+
+
+def load_reference(file_path=REFERENCE_PATH, rebuild=False):
+    '''
+    Returns the reference as a dict of arrays, building it first if there is
+    no cached copy.
+    '''
+    if rebuild or not os.path.exists(file_path):
+        build_reference(file_path)
+    with numpy.load(file_path) as data:
+        return dict((i, data[i]) for i in data.files)
+
+
+def species_float(kd, alpha, p_total, l_total, p):
+    return p, ligfit.get_pl(kd, alpha, l_total, p), ligfit.get_plp(kd, alpha, l_total, p)
+
+
+def evaluate_closed_form(kd, alpha, p_total, l_total):
+    a, b, c = ligfit.calc_abc(kd, alpha, p_total, l_total)
+    q, r = ligfit.calc_qr(a, b, c)
+    return species_float(kd, alpha, p_total, l_total, ligfit.solve_cubic(a, q, r))
+
+
+def ligfit_evaluator(mode, dps, tolerance):
+    '''
+    Returns an evaluator solving every point by free_protein with the given
+    precision mode, working precision and tolerance, exactly as ligfit run
+    with the matching options does. Without a mode no point is escalated and
+    the polished float64 root is kept.
+    '''
+    def evaluate(kd, alpha, p_total, l_total):
+        saved = ligfit.precision_mode, ligfit.precision_dps
+        ligfit.precision_mode = mode or ligfit.precision_mode
+        ligfit.precision_dps = dps or ligfit.precision_dps
+        try:
+            p = ligfit.free_protein(kd, alpha, p_total, l_total, tolerance=tolerance if mode else numpy.inf)
+        finally:
+            ligfit.precision_mode, ligfit.precision_dps = saved
+        return species_float(kd, alpha, p_total, l_total, p)
+    return evaluate
+
+
+def ligfit_options(mode, dps, tolerance):
+    '''
+    The ligfit options under which the model is evaluated as by the
+    evaluator of ligfit_evaluator.
+    '''
+    if not mode:
+        return ['--tolerance=inf']
+    options = ['--precision-mode={0}'.format(mode)]
+    if dps is not None:
+        options.append('--precision={0}'.format(dps))
+    return options + ['--tolerance={0:g}'.format(tolerance)]
+
+
+#The precision mode and working precision of each evaluator, cheapest first.
+#Every mode returns float64, escalating only the points beyond the
+#tolerance, and float64 escalates none. The unpolished closed form has no
+#such option and is shown only for comparison.
+MODES = [
+    ('float64', None, None),
+    ('longdouble', 'longdouble', None),
+    ('double-double', 'double-double', None),
+] + [('mpmath{0}'.format(dps), 'mpmath', dps) for dps in MPMATH_DPS]
+
+
+def relative_errors(values, reference):
+    '''
+    Returns the relative error of each float64 value against the reference
+    decimal strings.
+    '''
+    import mpmath
+    errors = numpy.empty(len(reference))
+    with mpmath.workdps(REFERENCE_DPS):
+        for i, (value, exact) in enumerate(zip(values, reference)):
+            value, exact = mpmath.mpf(float(value)), mpmath.mpf(str(exact))
+            errors[i] = float(abs(value - exact) / abs(exact)) if exact != 0 else float(abs(value))
+    return errors
+
+
+def select_region(reference, bounds):
+    '''
+    Returns the mask of the reference points within the log10 bounds given
+    for each of 'kd', 'alpha', 'p_total' and 'l_total'.
+    '''
+    mask = numpy.ones(len(reference['kd']), dtype=bool)
+    for name, (low, high) in bounds.items():
+        values = numpy.log10(reference[name])
+        mask &= (values >= low - 1e-9) & (values <= high + 1e-9)
+    return mask
+
+
+def measure(reference, mask, tolerance):
+    '''
+    Returns, for each evaluator, its ligfit options at the tolerance, its
+    largest relative error in each species over the selected points and its
+    throughput in points per second.
+    '''
+    args = [reference[i][mask] for i in ('kd', 'alpha', 'p_total', 'l_total')]
+    evaluators = [('float64-closed-form', evaluate_closed_form, None)]
+    evaluators += [(name, ligfit_evaluator(mode, dps, tolerance), ligfit_options(mode, dps, tolerance))
+                   for name, mode, dps in MODES]
+    results = []
+    for name, evaluate, options in evaluators:
+        start = time.perf_counter()
+        species = evaluate(*args)
+        seconds = time.perf_counter() - start
+        errors = dict((i, float(numpy.max(relative_errors(value, reference[i][mask]))))
+                      for i, value in zip(SPECIES, species))
+        results.append({'mode': name, 'options': options, 'max_relative_error': errors,
+                        'points_per_second': mask.sum() / seconds})
+    return results
+
+
+def recommend(results, tolerance):
+    '''
+    Returns the cheapest evaluator, among those usable in a fit, whose error
+    in every species is within the tolerance, or None. The evaluators are
+    taken in the order of MODES rather than by their measured throughput,
+    which is only noise between modes that escalate no point.
+    '''
+    usable = [i for i in results if i['options'] is not None
+              and max(i['max_relative_error'].values()) <= tolerance]
+    return usable[0] if usable else None
+
+
+def parse_bounds(arguments):
+    bounds = {}
+    for name, option in (('kd', '--kd-range'), ('alpha', '--alpha-range'),
+                         ('p_total', '--p-range'), ('l_total', '--l-range')):
+        if arguments[option]:
+            bounds[name] = [float(i) for i in arguments[option].split(',')]
+    return bounds
+
+
+if __name__ == '__main__':
+    from docopt import docopt
+    arguments = docopt(__doc__)
+    reference = load_reference(rebuild=arguments['--rebuild'])
+    bounds = parse_bounds(arguments)
+    mask = select_region(reference, bounds)
+    if not mask.any():
+        raise ValueError('No reference points lie within the region')
+    tolerance = float(arguments['--tolerance'])
+    results = measure(reference, mask, tolerance)
+    best = recommend(results, tolerance)
+    report = {'tolerance': tolerance, 'region': bounds, 'points': int(mask.sum()),
+              'reference_dps': int(reference['dps']), 'evaluators': results,
+              'recommended': best['mode'] if best else None,
+              'recommended_options': best['options'] if best else None}
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if arguments['--output']:
+        with open(arguments['--output'], 'w') as output:
+            output.write(text + '\n')
+    else:
+        print(text)
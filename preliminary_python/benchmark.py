@@ -0,0 +1,309 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""LigFit benchmarks
+
+Times the model and fitting hot paths: model_fitting and model_species at 10,
+1k and 1M points in each regime of the cubic, every precision mode (with
+mpmath at several working precisions), the compiled kernel where numba is
+installed, the chi-square surface and fits of the example data and the cold
+start of the command line. The compiled kernel is also checked against the
+NumPy float64 path, and a difference beyond its documented tolerance is
+reported as a mismatch.
+
+Each case is timed by the shortest of many repeated calls, and right after
+it a fixed reference workload is timed the same way. Results are written as
+JSON and compared against a stored baseline by their time relative to the
+reference, which cancels the changes in the speed of the machine between and
+during runs, and any case slower than the baseline by more than the
+tolerance is reported as a regression.
+
+Usage:
+  benchmark.py [--output=<json>] [--baseline=<json>] [--tolerance=<fraction>]
+               [--quick] [--save-baseline]
+
+Options:
+  --output=<json>         write the results to a file instead of standard
+                          output
+  --baseline=<json>       results to compare against
+                          [default: benchmark_baseline.json]
+  --tolerance=<fraction>  slowdown relative to the baseline that counts as a
+                          regression [default: 0.5]
+  --quick                 skip the cases at 1M points
+  --save-baseline         store these results as the new baseline
+  -h --help               show this help message and exit
+
+"""
+
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import numpy
+
+import compiled_kernel
+import ligfit
+from chi_surface import chi_square_surface
+from start_values import estimate_start
+
+DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+SIZES = (10, 1000, 1000000)
+MPMATH_SIZES = (10, 1000)
+MPMATH_DPS = (20, 30, 50)
+
+#Size of the NumPy arrays and of the Python loop of the reference workload
+REFERENCE_POINTS = 100000
+REFERENCE_LOOP = 20000
+
+#Kd, alpha, P_total and the log10 range of L_total of each regime. Only the
+#cartesian solution applies to the first, only the polar to the second, and
+#the third is the high-alpha case of resources/shifts_at_high_alpha.py
+REGIMES = {
+    'cartesian': (1.0, 100.0, 1.0, (-3.0, -0.5)),
+    'polar': (1.0, 1.0, 1.0, (-3.0, 3.0)),
+    'high_alpha': (1.0, 1e7, 1.0, (-2.0, 3.5)),
+}
+
+
+def time_call(func, setup=None, min_time=0.5, min_repeats=20, max_time=10.0, max_repeats=1000):
+    '''
+    Returns the shortest time of repeated calls of func, which noise can only
+    lengthen. The calls repeat until min_time has passed and min_repeats
+    calls are made, short of max_time (so that the slowest cases are timed
+    only a few times) and of max_repeats calls. setup is called before every
+    call, outside of the timing. A first, untimed call warms up the caches and
+    any lazy imports.
+    '''
+    if setup is not None:
+        setup()
+    func()
+    best, total, repeats = numpy.inf, 0.0, 0
+    while repeats < max_repeats and (total < min_time or (repeats < min_repeats and total < max_time)):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best, total, repeats = min(best, elapsed), total + elapsed, repeats + 1
+    return best
+
+
+def reference_workload():
+    '''
+    A fixed mix of NumPy arithmetic and interpreted Python, which no change
+    to LigFit can make faster or slower.
+    '''
+    values = numpy.linspace(1.0, 2.0, REFERENCE_POINTS)
+    numpy.sum(numpy.sqrt(values) * numpy.log(values))
+    total = 0
+    for i in range(REFERENCE_LOOP):
+        total += i * i
+    return total
+
+
+def record(results, name, seconds, points=None):
+    '''
+    Stores the seconds of a case, with the time of the reference workload
+    measured right after it, and its throughput if it is of a number of
+    points.
+    '''
+    results[name] = {'seconds': seconds, 'reference_seconds': time_call(reference_workload)}
+    if points is not None:
+        results[name]['points'] = points
+        results[name]['points_per_second'] = points / seconds
+
+
+def evaluate_at(mode, dps=None):
+    '''
+    Returns a function evaluating [PLP] with every point solved in the given
+    precision mode: 'float64' as model_fitting does on the NumPy path,
+    'compiled' as it does with the compiled kernel, or else escalated to
+    'double-double' or to 'mpmath' at dps (with a tolerance of zero). The
+    double-double roots are rounded to float64, so the tolerance that they
+    meet and the polished float64 roots do not is float64 eps itself.
+    '''
+    tolerance = numpy.finfo(numpy.float64).eps if mode == 'double-double' else 0.0
+
+    def evaluate(kd, alpha, p_total, l_total):
+        if mode in ('float64', 'compiled'):
+            ligfit.use_compiled = mode == 'compiled'
+            try:
+                return ligfit.model_fitting(l_total, kd, alpha, p_total)
+            finally:
+                ligfit.use_compiled = True
+        saved = ligfit.precision_mode, ligfit.precision_dps
+        ligfit.precision_mode = mode
+        ligfit.precision_dps = dps or ligfit.precision_dps
+        try:
+            p = ligfit.free_protein(kd, alpha, p_total, l_total, tolerance=tolerance)
+        finally:
+            ligfit.precision_mode, ligfit.precision_dps = saved
+        return ligfit.get_plp(kd, alpha, l_total, p)
+    return evaluate
+
+
+def model_cases(results, quick=False):
+    '''
+    Times the model in every regime, size and precision mode. The model cache
+    is disabled, so that every call is a fresh evaluation. Returns the cases
+    where the compiled kernel differs from the NumPy path by more than its
+    tolerance.
+    '''
+    cache_size = ligfit.MODEL_CACHE_SIZE
+    ligfit.MODEL_CACHE_SIZE = 0
+    mismatches = []
+    try:
+        for regime, (kd, alpha, p_total, (low, high)) in sorted(REGIMES.items()):
+            modes = [('float64', None, SIZES), ('double-double', None, SIZES)]
+            if compiled_kernel.available:
+                modes.append(('compiled', None, SIZES))
+            modes += [('mpmath', dps, MPMATH_SIZES) for dps in MPMATH_DPS]
+            for mode, dps, sizes in modes:
+                evaluate = evaluate_at(mode, dps)
+                for size in sizes:
+                    if quick and size > 1000:
+                        continue
+                    l_total = numpy.logspace(low, high, size)
+                    label = mode if dps is None else '{0}{1}'.format(mode, dps)
+                    seconds = time_call(lambda: evaluate(kd, alpha, p_total, l_total))
+                    name = 'model_fitting/{0}/{1}/{2}'.format(regime, label, size)
+                    record(results, name, seconds, size)
+                    if mode == 'compiled':
+                        reference = evaluate_at('float64')(kd, alpha, p_total, l_total)
+                        difference = numpy.max(numpy.abs(evaluate(kd, alpha, p_total, l_total) - reference)
+                                               / numpy.maximum(numpy.abs(reference), 1e-300))
+                        results[name]['max_relative_difference'] = float(difference)
+                        if not difference <= compiled_kernel.TOLERANCE:
+                            mismatches.append(name)
+                    if mode in ('float64', 'compiled'):
+                        ligfit.use_compiled = mode == 'compiled'
+                        seconds = time_call(lambda: ligfit.model_species(kd, alpha, p_total, l_total))
+                        ligfit.use_compiled = True
+                        record(results, 'model_species/{0}/{1}/{2}'.format(regime, label, size), seconds, size)
+    finally:
+        ligfit.MODEL_CACHE_SIZE = cache_size
+        ligfit.use_compiled = True
+    return mismatches
+
+
+def surface_cases(results):
+    '''
+    Times the chi-square surface of the example data over a 50 x 50 grid of
+    Kd and alpha, a bulk evaluation through solve_species, on the NumPy path
+    and with the compiled kernel where numba is installed.
+    '''
+    total_ligand, y_obs, y_err, p_total, guess = ligfit.load_fit_data(os.path.join(DIRECTORY, 'test.data'))
+    log_kd, log_alpha = numpy.linspace(1.0, 5.0, 50), numpy.linspace(-1.0, 6.0, 50)
+    modes = ['float64', 'compiled'] if compiled_kernel.available else ['float64']
+    try:
+        for mode in modes:
+            ligfit.use_compiled = mode == 'compiled'
+            seconds = time_call(lambda: chi_square_surface(total_ligand, y_obs, p_total, log_kd, log_alpha,
+                                                           y_err=y_err))
+            points = log_kd.size * log_alpha.size * len(total_ligand)
+            record(results, 'surface/test.data/{0}'.format(mode), seconds, points)
+    finally:
+        ligfit.use_compiled = True
+
+
+def fit_cases(results):
+    '''
+    Times complete fits of the example data by least squares and by
+    orthogonal distance regression, from a cold model cache and the starting
+    values ligfit.py fit would use.
+    '''
+    for file_name in ('test.data', 'jam.txt'):
+        total_ligand, y_obs, y_err, p_total, guess = ligfit.load_fit_data(os.path.join(DIRECTORY, file_name))
+        p0 = estimate_start(total_ligand, y_obs, p_total, guess)
+        fits = {'lsq': lambda: ligfit.fit_lsq(total_ligand, y_obs, p_total, p0=p0),
+                'odr': lambda: ligfit.fit_odr(total_ligand, y_obs, y_err, p_total, p0=p0)}
+        for method, func in sorted(fits.items()):
+            name = 'fit/{0}/{1}'.format(file_name, method)
+            try:
+                seconds = time_call(func, setup=ligfit.clear_model_cache)
+            except RuntimeError as error:
+                #An unconverged fit is still timed, but marked as such
+                start = time.perf_counter()
+                try:
+                    func()
+                except RuntimeError:
+                    pass
+                record(results, name, time.perf_counter() - start)
+                results[name]['error'] = str(error)
+                continue
+            record(results, name, seconds)
+
+
+def cold_start(results):
+    '''
+    Times starting the command line to its help text in a new interpreter.
+    '''
+    command = [sys.executable, os.path.join(DIRECTORY, 'ligfit.py'), '--help']
+    with open(os.devnull, 'w') as devnull:
+        seconds = time_call(lambda: subprocess.check_call(command, stdout=devnull), min_time=1.0)
+    record(results, 'cold_start/help', seconds)
+
+
+def run_benchmarks(quick=False):
+    results = {}
+    mismatches = model_cases(results, quick=quick)
+    surface_cases(results)
+    fit_cases(results)
+    cold_start(results)
+    return {'environment': {'python': platform.python_version(), 'numpy': numpy.__version__,
+                            'numba': compiled_kernel.numba.__version__ if compiled_kernel.available else None,
+                            'machine': platform.machine(), 'platform': platform.platform()},
+            'results': results, 'mismatches': mismatches}
+
+
+def compare(report, baseline, tolerance):
+    '''
+    Adds to each result its time relative to the baseline, both taken
+    relative to the reference workload timed with them, and returns the
+    names of the cases slower than the baseline by more than the tolerance.
+    '''
+    regressions = []
+    for name, result in sorted(report['results'].items()):
+        if name not in baseline['results']:
+            continue
+        previous = baseline['results'][name]
+        ratio = ((result['seconds'] / result['reference_seconds'])
+                 / (previous['seconds'] / previous['reference_seconds']))
+        result['baseline_ratio'] = ratio
+        if ratio > 1.0 + tolerance:
+            regressions.append(name)
+    report['regressions'] = regressions
+    return regressions
+
+
+if __name__ == '__main__':
+    from docopt import docopt
+    arguments = docopt(__doc__)
+    report = run_benchmarks(quick=arguments['--quick'])
+
+    baseline_path = os.path.join(DIRECTORY, arguments['--baseline'])
+    regressions = []
+    if os.path.exists(baseline_path) and not arguments['--save-baseline']:
+        with open(baseline_path) as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = compare(report, baseline, float(arguments['--tolerance']))
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if arguments['--output']:
+        with open(arguments['--output'], 'w') as output:
+            output.write(text + '\n')
+    else:
+        print(text)
+    if arguments['--save-baseline']:
+        with open(baseline_path, 'w') as baseline_file:
+            baseline_file.write(text + '\n')
+    for name in regressions:
+        sys.stderr.write('regression: {0} is {1:.2f}x the baseline relative time\n'.format(
+            name, report['results'][name]['baseline_ratio']))
+    for name in report['mismatches']:
+        sys.stderr.write('mismatch: {0} differs from float64 by {1:.3g}\n'.format(
+            name, report['results'][name]['max_relative_difference']))
+    sys.exit(1 if regressions or report['mismatches'] else 0)
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Bootstrap confidence intervals for the fitted Kd, alpha and scaling factor.
+The linearized covariance of a fit says little when alpha spans many orders
+of magnitude, so instead many replicate datasets are made, either by
+resampling the residuals of the best fit or by drawing noise from the
+Y-error, and each is refitted.
+
+The replicates share their ligand concentrations and are refitted together
+with the stacked Levenberg-Marquardt solver, warm-started from the best fit,
+in chunks spread over a process pool.
+"""
+
+import numpy
+
+from stacked_lm import fit_stacked, stacked_model
+
+RESAMPLE_SOURCES = ('residuals', 'errors')
+
+
+def replicate_data(l_total, y_obs, popt, p_total, n_replicates, y_err=None, seed=None):
+    '''
+    Returns an (n_replicates, M) array of synthetic Y-observed about the best
+    fit. Without y_err the residuals of the best fit are resampled with
+    replacement, inflated for the three fitted degrees of freedom; with y_err
+    each point is drawn from a normal distribution of that standard deviation.
+    '''
+    random = numpy.random.RandomState(seed)
+    n_points = len(l_total)
+    model = stacked_model(l_total[numpy.newaxis], numpy.asarray(popt, numpy.float64)[numpy.newaxis], p_total)[0]
+    if y_err is None:
+        residuals = (y_obs - model) * numpy.sqrt(n_points / float(max(n_points - 3, 1)))
+        noise = residuals[random.randint(0, n_points, size=(n_replicates, n_points))]
+    else:
+        noise = random.standard_normal((n_replicates, n_points)) * y_err
+    return model + noise
+
+
+def fit_replicates(args):
+    '''
+    Refits a chunk of replicates, given as a tuple of the ligand
+    concentrations, the replicate Y-observed (K, M), p_total and the best fit
+    to start from. Returns the parameters (K, 3) and whether each converged.
+    '''
+    l_total, y_replicates, p_total, popt = args
+    params, pcov, cost, converged = fit_stacked([l_total] * len(y_replicates), list(y_replicates),
+                                                p_total, p0=popt)
+    return params, converged
+
+
+def bootstrap(l_total, y_obs, p_total, popt, n_replicates, y_err=None, processes=1, seed=None):
+    '''
+    Refits n_replicates bootstrap replicates of a dataset about its best fit
+    popt (Kd, alpha and the scaling factor), drawing them from y_err if given
+    or else from the residuals. The replicates are split evenly across the
+    given number of processes.
+
+    Returns the parameters of every replicate (n_replicates, 3) and whether
+    each replicate fit converged.
+    '''
+    y_replicates = replicate_data(l_total, y_obs, popt, p_total, n_replicates, y_err=y_err, seed=seed)
+    processes = max(1, min(processes, n_replicates))
+    chunks = [(l_total, i, p_total, popt) for i in numpy.array_split(y_replicates, processes)]
+    if processes == 1:
+        results = [fit_replicates(i) for i in chunks]
+    else:
+        import multiprocessing
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(fit_replicates, chunks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    params, converged = zip(*results)
+    return numpy.concatenate(params), numpy.concatenate(converged)
+
+
+def percentile_intervals(params, converged=None, level=0.95):
+    '''
+    Returns the lower and upper percentile bounds (3, 2) of each parameter
+    at the given confidence level, over the replicates that converged.
+    '''
+    if converged is not None:
+        params = params[converged]
+    tail = 50.0 * (1.0 - level)
+    return numpy.percentile(params, [tail, 100.0 - tail], axis=0).T
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+The chi-square surface of a dataset over a grid of log Kd and log alpha, for
+checking how well the two are identified. Rather than fitting or evaluating
+the model one grid cell at a time, every cell of a chunk of the grid is
+evaluated together by broadcasting, and the chunks are sized so that memory
+stays bounded whatever the size of the grid.
+
+At each cell the scaling factor is either fixed or profiled out: the model is
+linear in it, so its optimum follows in closed form.
+"""
+
+import numpy
+
+from ligfit import solve_species
+
+#Upper limit on the number of model points evaluated at once
+CHUNK_POINTS = 1 << 20
+
+
+def chi_square_surface(total_ligand, y_obs, p_total, log_kd, log_alpha, y_err=None,
+                       scaling=None, chunk_points=CHUNK_POINTS, tolerance=None):
+    '''
+    Returns the chi-square (len(log_kd), len(log_alpha)) at every pair of
+    log10 Kd and log10 alpha, with the scaling factor used at each. The
+    residuals are weighted by the Y-errors where these are given, with any
+    zero error replaced by the smallest non-zero one. Unless a scaling is
+    given it is profiled out, i.e. set to its optimum at every cell.
+    '''
+    log_kd = numpy.asarray(log_kd, numpy.float64)
+    log_alpha = numpy.asarray(log_alpha, numpy.float64)
+    weight = numpy.ones_like(y_obs)
+    if y_err is not None:
+        #Zero errors are replaced with the smallest non-zero one, as by fit_odr
+        positive = y_err[y_err > 0]
+        if positive.size:
+            weight = numpy.power(numpy.where(y_err > 0, y_err, positive.min()), -2.0)
+
+    kd = numpy.power(10.0, log_kd)
+    alpha = numpy.power(10.0, log_alpha)
+    n_cells = kd.size * alpha.size
+    chi_square = numpy.empty(n_cells)
+    scalings = numpy.empty(n_cells)
+    step = max(1, chunk_points // len(total_ligand))
+    for start in range(0, n_cells, step):
+        cells = numpy.arange(start, min(start + step, n_cells))
+        kd_cells = kd[cells // alpha.size, numpy.newaxis]
+        alpha_cells = alpha[cells % alpha.size, numpy.newaxis]
+        species = solve_species(kd_cells, alpha_cells, p_total, total_ligand, tolerance=tolerance,
+                                scratch='chi_surface')
+        model = numpy.nan_to_num(species[2])
+        if scaling is None:
+            #Weighted linear least squares for the scaling of each cell
+            s = numpy.sum(weight * model * y_obs, axis=1) / numpy.maximum(numpy.sum(weight * model * model, axis=1), 1e-300)
+        else:
+            s = numpy.full(len(cells), float(scaling))
+        residual = s[:, numpy.newaxis] * model - y_obs
+        chi_square[cells] = numpy.sum(weight * residual * residual, axis=1)
+        scalings[cells] = s
+    shape = (kd.size, alpha.size)
+    return chi_square.reshape(shape), scalings.reshape(shape)
+
+
+def write_surface(file_path, log_kd, log_alpha, chi_square, scaling):
+    '''
+    Writes a surface to a .npz file, with its axes, for plotting.
+    '''
+    numpy.savez(file_path, log_kd=log_kd, log_alpha=log_alpha, chi_square=chi_square, scaling=scaling)
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+An optional compiled backend for solve_species, and so for model_species
+and the bulk evaluations of surfaces, grids and stacked fits. Where numba is
+installed, the whole per-point pipeline (a, b and c, Q and R, the choice
+between the cartesian and polar solutions, the Halley polish of polish_root
+with its error bound, and the species of get_species) is fused into a single
+loop, run in parallel across the cores, in place of the dozen or so passes
+over memory of the NumPy path. Without numba, compiled_species returns None
+and solve_species falls back to the NumPy path.
+
+The loop performs the same float64 operations in the same order as the NumPy
+path, but cbrt, arccos and cos come from the C library rather than from
+NumPy, which may differ from them in the last bit. Both roots are polished
+to rounding, so every species agrees with the NumPy float64 path to a
+relative TOLERANCE. Points whose error bound exceeds the precision
+tolerance are recomputed by free_protein, and so escalated just as before.
+"""
+
+import os
+
+import numpy
+
+import telemetry
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+#The default threading layer (TBB where installed) leaves a process that has
+#run the kernel hung at exit once it forks a multiprocessing pool, as the
+#bootstrap, batch, multistart and solution grid do, so the fork-safe
+#workqueue layer is used unless NUMBA_THREADING_LAYER says otherwise
+if numba is not None and 'NUMBA_THREADING_LAYER' not in os.environ:
+    numba.config.THREADING_LAYER = 'workqueue'
+
+available = numba is not None
+
+#Largest relative difference of any species from the NumPy float64 path, as
+#checked by benchmark.py
+TOLERANCE = 1e-13
+
+#Iterations of polish_root: at least MIN_ITERATIONS, and at most
+#MAX_ITERATIONS for points whose closed form was far off
+MIN_ITERATIONS = 2
+MAX_ITERATIONS = 100
+
+EPS = numpy.finfo(numpy.float64).eps
+
+prange = numba.prange if available else range
+
+
+def species_kernel(kd, alpha, p_total, l_total, out, error):
+    '''
+    Fills out (4, N) with [P], [PL], [PLP] and free ligand, and error (N,)
+    with the bound on the relative error of [P] of polish_root, at each of
+    the N points of the 1-D float64 arrays kd, alpha, p_total and l_total.
+    Returns the number of points taking the polar solution of the cubic.
+    '''
+    polar = 0
+    for i in prange(l_total.shape[0]):
+        k, al, pt, lt = kd[i], alpha[i], p_total[i], l_total[i]
+        a = (2.0 * k) / al + (2.0 * lt) - pt
+        b = (k + 2.0 * lt - 2.0 * pt) * (k / al)
+        c = (-1.0 * (k * k) * pt) / al
+        q = (3.0 * b - a * a) / 9.0
+        r = (9.0 * a * b - 27.0 * c - 2.0 * (a * a * a)) / 54.0
+        disc = q * q * q + r * r
+        if disc > 0:
+            root = numpy.sqrt(disc)
+            p = a / -3.0 + numpy.cbrt(r + root) + numpy.cbrt(r - root)
+        else:
+            polar += 1
+            cos_theta = min(max(r / numpy.sqrt(-1.0 * (q * q * q)), -1.0), 1.0)
+            p = numpy.cos(numpy.arccos(cos_theta) / 3.0) * numpy.sqrt(-1.0 * q) * 2.0 - a / 3.0
+
+        #The Halley iterations of polish_root, bracketed by the sign of the
+        #cubic and falling back to bisection
+        if not (p > 0 and p < pt):
+            p = 0.5 * pt
+        lower, upper, step = 0.0, pt, numpy.inf
+        for iteration in range(MAX_ITERATIONS):
+            f = ((p + a) * p + b) * p + c
+            df = (3.0 * p + 2.0 * a) * p + b
+            ddf = 6.0 * p + 2.0 * a
+            if f < 0:
+                lower = p
+            elif f > 0:
+                upper = p
+            new = p - 2.0 * f * df / (2.0 * df * df - f * ddf)
+            if not (new > lower and new < upper):
+                new = numpy.sqrt(lower * upper) if lower > 0 else 0.5 * (lower + upper)
+            if f == 0:
+                new = p
+            step = abs(new - p)
+            p = new
+            if iteration + 1 >= MIN_ITERATIONS and not step > 4.0 * EPS * new:
+                break
+
+        p_sq = p * p
+        f = ((p + a) * p + b) * p + c
+        df = (3.0 * p + 2.0 * a) * p + b
+        magnitude = (p_sq * p + (2.0 * k / al + 2.0 * lt + pt) * p_sq
+                     + (k + 2.0 * lt + 2.0 * pt) * (k / al) * p + (k * k) * pt / al)
+        bound = max((abs(f) + 8.0 * EPS * magnitude) / abs(df * p), step / p)
+        error[i] = bound if p > 0 and p <= pt and bound == bound else numpy.inf
+
+        #get_species: D = Kd (Kd + 2P) + alpha P^2, shared through L_total/D
+        alpha_p_sq = p_sq * al
+        ratio = lt / ((p * 2.0 + k) * k + alpha_p_sq)
+        out[0, i] = p
+        out[1, i] = p * ratio * (2.0 * k)
+        out[2, i] = alpha_p_sq * ratio
+        out[3, i] = ratio * (k * k)
+    return polar
+
+
+if available:
+    species_kernel = numba.njit(parallel=True, cache=True, nogil=True)(species_kernel)
+
+
+@telemetry.timed('compiled_species')
+def compiled_species(kd, alpha, p_total, l_total, tolerance, out=None):
+    '''
+    Returns the species of get_species (4, ...) evaluated by the compiled
+    kernel, recomputing the points whose error bound exceeds the tolerance by
+    free_protein, and written into out (a contiguous array) if given.
+    Returns None without numba, or for inputs other than float64, which are
+    left to the NumPy path.
+
+    The stages of the kernel are fused, so its time is reported as a whole
+    under compiled_species rather than as calc_abc, calc_qr and solve_cubic,
+    but it counts the points taking each branch of the cubic as they do.
+    '''
+    if not available:
+        return None
+    arrays = numpy.broadcast_arrays(kd, alpha, p_total, l_total)
+    if any(numpy.result_type(i, 1.0) != numpy.float64 for i in arrays):
+        return None
+    import ligfit
+    shape = arrays[0].shape
+    size = int(numpy.prod(shape))
+    #The broadcast inputs and the error bounds go in the workspace, the
+    #species where the caller asks
+    inputs = ligfit.workspace('compiled_inputs', (4, size))
+    for row, i in zip(inputs, arrays):
+        numpy.copyto(row.reshape(shape), i)
+    kd, alpha, p_total, l_total = inputs
+    out = numpy.empty((4, size)) if out is None else out.reshape((4, size))
+    error = ligfit.workspace('compiled_error', (size,))
+    polar = species_kernel(kd, alpha, p_total, l_total, out, error)
+    if telemetry.enabled:
+        telemetry.count('compiled_points', size)
+        telemetry.count('cartesian_points', size - polar)
+        telemetry.count('polar_points', polar)
+
+    flagged = error > tolerance
+    if flagged.any():
+        kd, alpha, p_total, l_total = [i[flagged] for i in (kd, alpha, p_total, l_total)]
+        p = ligfit.free_protein(kd, alpha, p_total, l_total, tolerance=tolerance)
+        out[:, flagged] = ligfit.get_species(kd, alpha, l_total, p)
+    return out.reshape((4,) + shape)
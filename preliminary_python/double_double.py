@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Double-double arithmetic on NumPy arrays. A value is held as a pair of
+float64 arrays (hi, lo) whose unevaluated sum carries about 32 significant
+digits, and every operation is a short sequence of vectorized float64
+operations built on the error-free transformations of Dekker and Knuth. This
+gives ~32-digit precision at a small multiple of the cost of float64, where
+arrays of mpf objects cost a Python call per element.
+
+Only the operations needed by the model are provided: addition,
+multiplication, division, square and cube roots, arccos and cos, and the
+solution of the cubic for [P]-free built from them.
+"""
+
+import numpy
+
+#Unit roundoff of a double-double value, 2^-104
+EPS = 2.0 ** -104
+
+#Splits a float64 into two halves of 26 bits (2^27 + 1)
+_SPLITTER = 134217729.0
+
+
+def to_dd(x):
+    '''
+    Returns a float64 value or array as a double-double.
+    '''
+    hi = numpy.asarray(x, numpy.float64)
+    return hi, numpy.zeros_like(hi)
+
+
+def two_sum(a, b):
+    s = a + b
+    v = s - a
+    return s, (a - (s - v)) + (b - v)
+
+
+def quick_two_sum(a, b):
+    '''
+    The error-free sum of a and b where |a| >= |b|.
+    '''
+    s = a + b
+    return s, b - (s - a)
+
+
+def split(a):
+    t = _SPLITTER * a
+    hi = t - (t - a)
+    return hi, a - hi
+
+
+def two_prod(a, b):
+    p = a * b
+    a_hi, a_lo = split(a)
+    b_hi, b_lo = split(b)
+    return p, ((a_hi * b_hi - p) + a_hi * b_lo + a_lo * b_hi) + a_lo * b_lo
+
+
+def dd_add(a, b):
+    s, e = two_sum(a[0], b[0])
+    t, f = two_sum(a[1], b[1])
+    s, e = quick_two_sum(s, e + t)
+    return quick_two_sum(s, e + f)
+
+
+def dd_neg(a):
+    return -a[0], -a[1]
+
+
+def dd_sub(a, b):
+    return dd_add(a, dd_neg(b))
+
+
+def dd_mul(a, b):
+    p, e = two_prod(a[0], b[0])
+    return quick_two_sum(p, e + (a[0] * b[1] + a[1] * b[0]))
+
+
+def dd_scale(a, x):
+    '''
+    Multiplies a double-double by a float64 constant.
+    '''
+    p, e = two_prod(a[0], x)
+    return quick_two_sum(p, e + a[1] * x)
+
+
+def dd_div(a, b):
+    #Long division, each quotient digit correcting the remainder of the last
+    q1 = a[0] / b[0]
+    r = dd_sub(a, dd_scale(b, q1))
+    q2 = r[0] / b[0]
+    r = dd_sub(r, dd_scale(b, q2))
+    q3 = r[0] / b[0]
+    return dd_add(quick_two_sum(q1, q2), to_dd(q3))
+
+
+def dd_sqrt(a):
+    '''
+    The square root by one Newton step from the float64 root (Karp's
+    method), which doubles its precision. Zero maps to zero.
+    '''
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        x = 1.0 / numpy.sqrt(a[0])
+        ax = a[0] * x
+        correction = dd_sub(a, dd_mul(to_dd(ax), to_dd(ax)))[0] * (x * 0.5)
+        root = two_sum(ax, correction)
+    zero = a[0] == 0
+    return numpy.where(zero, 0.0, root[0]), numpy.where(zero, 0.0, root[1])
+
+
+def dd_cbrt(a):
+    '''
+    The real cube root by one Newton step from the float64 root. Zero maps
+    to zero.
+    '''
+    x = numpy.cbrt(a[0])
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        x_dd = to_dd(x)
+        residual = dd_sub(a, dd_mul(dd_mul(x_dd, x_dd), x_dd))
+        root = two_sum(x, residual[0] / (3.0 * x * x))
+    zero = a[0] == 0
+    return numpy.where(zero, 0.0, root[0]), numpy.where(zero, 0.0, root[1])
+
+
+def _inverse_factorials(n):
+    terms = [to_dd(1.0)]
+    for i in range(1, n + 1):
+        terms.append(dd_div(terms[-1], to_dd(float(i))))
+    return terms
+
+
+#1/k! for the Taylor series of sin and cos, each as a double-double
+_INVERSE_FACTORIALS = _inverse_factorials(27)
+
+#Halvings of the argument before the series is summed
+_HALVINGS = 4
+
+
+def dd_sin_cos(a):
+    '''
+    Returns the sine and cosine of a double-double angle. The argument is
+    divided by 2^4 (exactly), the Taylor series summed to 1/27!, and the
+    double-angle formulas applied to recover the full angle. Accurate to
+    about 30 digits for arguments within a few multiples of pi.
+    '''
+    t = (a[0] / 2.0 ** _HALVINGS, a[1] / 2.0 ** _HALVINGS)
+    t_sq = dd_mul(t, t)
+    #sin t / t and cos t summed from the smallest term, by Horner's rule
+    sin = cos = to_dd(numpy.zeros_like(t[0]))
+    for k in range(27, 0, -2):
+        sin = dd_add(dd_scale(_INVERSE_FACTORIALS[k], (-1.0) ** (k // 2)), dd_mul(t_sq, sin))
+    for k in range(26, -1, -2):
+        cos = dd_add(dd_scale(_INVERSE_FACTORIALS[k], (-1.0) ** (k // 2)), dd_mul(t_sq, cos))
+    sin = dd_mul(t, sin)
+    for i in range(_HALVINGS):
+        #cos 2t = 1 - 2 sin^2 t keeps the precision near cos = 1
+        sin, cos = dd_scale(dd_mul(sin, cos), 2.0), dd_sub(to_dd(1.0), dd_scale(dd_mul(sin, sin), 2.0))
+    return sin, cos
+
+
+def dd_cos(a):
+    return dd_sin_cos(a)[1]
+
+
+def dd_acos(a):
+    '''
+    The arccos by Newton steps on cos(theta) = a from the float64 arccos.
+    The argument must lie within [-1, 1]; near its ends the result is only
+    as good as the problem allows.
+    '''
+    theta = to_dd(numpy.arccos(numpy.clip(a[0], -1.0, 1.0)))
+    for i in range(2):
+        sin, cos = dd_sin_cos(theta)
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            step = dd_sub(cos, a)[0] / sin[0]
+        theta = dd_add(theta, to_dd(numpy.where(numpy.isfinite(step), step, 0.0)))
+    return theta
+
+
+def calc_abc_dd(kd, alpha, p_total, l_total):
+    '''
+    The cubic constants a, b, and c of ligfit.calc_abc, as double-doubles.
+    '''
+    kd_alpha = dd_div(kd, alpha)
+    two_l = dd_scale(l_total, 2.0)
+    a = dd_sub(dd_add(dd_scale(kd_alpha, 2.0), two_l), p_total)
+    b = dd_mul(dd_sub(dd_add(kd, two_l), dd_scale(p_total, 2.0)), kd_alpha)
+    c = dd_neg(dd_mul(dd_mul(kd, kd_alpha), p_total))
+    return a, b, c
+
+
+def calc_qr_dd(a, b, c):
+    '''
+    Q and R of ligfit.calc_qr, as double-doubles.
+    '''
+    a_sq = dd_mul(a, a)
+    q = dd_div(dd_sub(dd_scale(b, 3.0), a_sq), to_dd(9.0))
+    r = dd_sub(dd_sub(dd_scale(dd_mul(a, b), 9.0), dd_scale(c, 27.0)), dd_scale(dd_mul(a_sq, a), 2.0))
+    return q, dd_div(r, to_dd(54.0))
+
+
+def solve_cubic_dd(a, q, r):
+    '''
+    The cartesian or polar solution of the cubic for [P]-free, as in
+    ligfit.solve_cubic, in double-double arithmetic.
+    '''
+    q_cu = dd_mul(dd_mul(q, q), q)
+    disc = dd_add(q_cu, dd_mul(r, r))
+    cartesian = disc[0] > 0
+    third_a = dd_div(a, to_dd(3.0))
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        root = dd_sqrt((numpy.abs(disc[0]), numpy.where(disc[0] < 0, -disc[1], disc[1])))
+        p_cartesian = dd_sub(dd_add(dd_cbrt(dd_add(r, root)), dd_cbrt(dd_sub(r, root))), third_a)
+
+        magnitude = dd_sqrt((numpy.abs(q[0]), numpy.where(q[0] < 0, -q[1], q[1])))
+        cos_theta = dd_div(r, dd_mul(dd_mul(magnitude, magnitude), magnitude))
+        theta = dd_acos((numpy.clip(cos_theta[0], -1.0, 1.0), numpy.where(numpy.abs(cos_theta[0]) < 1.0, cos_theta[1], 0.0)))
+        p_polar = dd_sub(dd_scale(dd_mul(dd_cos(dd_div(theta, to_dd(3.0))), magnitude), 2.0), third_a)
+    return (numpy.where(cartesian, p_cartesian[0], p_polar[0]),
+            numpy.where(cartesian, p_cartesian[1], p_polar[1]))
+
+
+def free_protein_dd(kd, alpha, p_total, l_total, p=None, iterations=2):
+    '''
+    Returns [P]-free in double-double precision (as a pair of arrays) for
+    float64 parameters, with a bound on its relative error as
+    ligfit.polish_root gives. Newton steps on the cubic in double-double
+    start from whichever has the smaller residual of the double-double
+    closed form and the float64 root p, which is the polished float64 root
+    unless given. (The closed form alone can cancel past even 32 digits.)
+    '''
+    if p is None:
+        import ligfit
+        a, b, c = ligfit.calc_abc(kd, alpha, p_total, l_total)
+        q, r = ligfit.calc_qr(a, b, c)
+        p = ligfit.polish_root(kd, alpha, p_total, l_total, ligfit.solve_cubic(a, q, r))[0]
+    kd, alpha, p_total, l_total = [to_dd(i) for i in numpy.broadcast_arrays(kd, alpha, p_total, l_total)]
+    a, b, c = calc_abc_dd(kd, alpha, p_total, l_total)
+    q, r = calc_qr_dd(a, b, c)
+    x = solve_cubic_dd(a, q, r)
+
+    def cubic(x):
+        x_sq = dd_mul(x, x)
+        f = dd_add(dd_add(dd_mul(x_sq, dd_add(x, a)), dd_mul(b, x)), c)
+        df = dd_add(dd_add(dd_scale(x_sq, 3.0), dd_scale(dd_mul(a, x), 2.0)), b)
+        return f, df
+
+    with numpy.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        start = to_dd(numpy.broadcast_to(p, x[0].shape))
+        better = ~(numpy.abs(cubic(start)[0][0]) >= numpy.abs(cubic(x)[0][0]))
+        x = numpy.where(better, start[0], x[0]), numpy.where(better, start[1], x[1])
+        step = numpy.full_like(x[0], numpy.inf)
+        for i in range(iterations):
+            f, df = cubic(x)
+            delta = dd_div(f, df)
+            x = dd_sub(x, delta)
+            step = numpy.abs(delta[0])
+
+        f, df = cubic(x)
+        x_sq = dd_mul(x, x)[0]
+        kd, alpha, p_total, l_total = kd[0], alpha[0], p_total[0], l_total[0]
+        magnitude = (x_sq * x[0] + (2.0 * kd / alpha + 2.0 * l_total + p_total) * x_sq
+                     + (kd + 2.0 * l_total + 2.0 * p_total) * (kd / alpha) * x[0] + kd * kd * p_total / alpha)
+        error = numpy.fmax((numpy.abs(f[0]) + 8.0 * EPS * magnitude) / numpy.abs(df[0] * x[0]), step / x[0])
+        error = numpy.where((x[0] > 0) & (x[0] <= p_total), error, numpy.inf)
+        error = numpy.where(numpy.isnan(error), numpy.inf, error)
+    return x, error
@@ -0,0 +1,309 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+A long-running local fitting service, started with `ligfit.py serve`. It
+keeps a pool of worker processes with scipy, the solution table and the model
+already imported and warmed up, and takes fit jobs as JSON over HTTP on a
+local TCP port or Unix socket, so that each fit costs only the fit itself.
+
+  POST /fit     a single job, answered with its result, or {"jobs": [...]}
+                answered with {"results": [...]} in the same order
+  GET /status   the number of workers, the jobs pending and the capacity
+
+A job gives either "input", the path of an input file, or the data itself as
+"l_total", "y_obs" and optionally "y_err" and "p_total" (default 0.1), with
+the Y-observed and Y-error normalized as by `ligfit.py fit`. It may also give
+"method", lsq (the default) or odr, and starting values "p0" as [Kd, alpha,
+scaling]; otherwise these are estimated from the data, with any "init_kd" and
+"init_alpha" (as in the header of an input file) as a further candidate. A
+result holds the parameters, their standard errors and covariance, the
+residual norm, and as diagnostics the instrumentation report of the fit with
+the optimizer outcome and the model cache hits and misses of the job. A job
+that fails has a status of failed and the error instead.
+
+At most one job per worker runs at a time and at most --queue more wait. A
+request whose jobs would exceed that is refused with 503 straight away,
+rather than queued without limit, and a batch larger than the capacity with
+413.
+"""
+
+import asyncio
+import json
+import os
+import socket
+import sys
+import time
+
+import numpy
+
+import ligfit
+import telemetry
+from start_values import estimate_start
+
+HOST = '127.0.0.1'
+PORT = 8765
+
+#Largest request body accepted, and the time allowed to send a request
+MAX_BODY = 16 << 20
+READ_TIMEOUT = 30.0
+
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+           413: 'Payload Too Large', 500: 'Internal Server Error', 503: 'Service Unavailable'}
+
+
+def warm_worker(settings):
+    '''
+    Runs once in each worker process: applies the precision settings of the
+    service and imports and exercises everything a fit needs.
+    '''
+    for name, value in settings.items():
+        setattr(ligfit, name, value)
+    import scipy.optimize
+    import scipy.sparse
+    from solution_table import load_table
+    #estimate_start falls back to the table for data that shows neither its
+    #maximum nor a half-rise
+    load_table()
+    ligfit.model_species(1.0, 1.0, 0.1, numpy.logspace(-2.0, 2.0, 8))
+
+
+def ping():
+    return os.getpid()
+
+
+def finite(values):
+    '''
+    Converts an array to nested lists for JSON, with None for values that
+    are not finite.
+    '''
+    values = numpy.asarray(values, numpy.float64)
+    return numpy.where(numpy.isfinite(values), values, None).tolist()
+
+
+def job_data(job):
+    '''
+    Returns the total ligand, the normalized Y-observed and Y-error, the
+    protein concentration and any guesses of Kd and alpha of a job.
+    '''
+    if 'input' in job:
+        return ligfit.load_fit_data(job['input'])
+    total_ligand = numpy.asarray(job['l_total'], numpy.float64)
+    y_obs = numpy.asarray(job['y_obs'], numpy.float64)
+    y_err = numpy.asarray(job.get('y_err', numpy.zeros_like(y_obs)), numpy.float64)
+    if not total_ligand.shape == y_obs.shape == y_err.shape or total_ligand.ndim != 1:
+        raise ValueError('l_total, y_obs and y_err must be lists of the same length')
+    guess = (float(job['init_kd']), float(job['init_alpha'])) if 'init_kd' in job and 'init_alpha' in job else None
+    return (total_ligand, y_obs / y_obs.max(), y_err / y_obs.max(),
+            float(job.get('p_total', ligfit.DEFAULT_P_TOTAL)), guess)
+
+
+def run_job(job):
+    '''
+    Fits a single job in a worker, returning its result. Any failure is
+    recorded in the result rather than raised, as for the batch rows.
+    '''
+    start = time.time()
+    cache_before = ligfit.model_cache_info()
+    result = {'status': 'ok'}
+    try:
+        with telemetry.collect():
+            total_ligand, y_obs, y_err, p_total, guess = job_data(job)
+            p0 = job.get('p0') or estimate_start(total_ligand, y_obs, p_total, guess)
+            method = job.get('method', 'lsq')
+            if method == 'lsq':
+                popt, pcov = ligfit.fit_lsq(total_ligand, y_obs, p_total, p0=p0)
+            elif method == 'odr':
+                popt, pcov = ligfit.fit_odr(total_ligand, y_obs, y_err, p_total, p0=p0)
+            else:
+                raise ValueError('method must be lsq or odr')
+        residuals = popt[2] * ligfit.model_fitting(total_ligand, popt[0], popt[1], p_total) - y_obs
+        for name, value in zip(ligfit.BATCH_PARAMETERS, popt):
+            result[name] = float(value)
+        result['errors'] = finite(numpy.sqrt(numpy.diag(pcov)))
+        result['covariance'] = finite(pcov)
+        result['residual_norm'] = float(numpy.linalg.norm(residuals))
+    except Exception as error:
+        result = {'status': 'failed', 'error': '{0}: {1}'.format(type(error).__name__, error)}
+    result['diagnostics'] = telemetry.report()
+    #The cache statistics of the worker are cumulative, so only this job's
+    #share of them is reported
+    cache = ligfit.model_cache_info()
+    for name in ('hits', 'misses'):
+        cache[name] -= cache_before[name]
+    result['diagnostics']['model_cache'] = cache
+    result['seconds'] = time.time() - start
+    return result
+
+
+async def run_in_pool(state, job):
+    async with state['slots']:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(state['executor'], run_job, job)
+
+
+async def fit_jobs(state, payload):
+    '''
+    Admits the jobs of a request if there is room for them, and returns the
+    status and reply once they are all done.
+    '''
+    if not isinstance(payload, dict):
+        return 400, {'error': 'the request must be a JSON object'}
+    batched = 'jobs' in payload
+    jobs = payload['jobs'] if batched else [payload]
+    if not isinstance(jobs, list) or not all(isinstance(i, dict) for i in jobs):
+        return 400, {'error': 'jobs must be a list of JSON objects'}
+    if len(jobs) > state['capacity']:
+        return 413, {'error': 'a batch may hold at most {0} jobs'.format(state['capacity'])}
+    if state['pending'] + len(jobs) > state['capacity']:
+        return 503, {'error': 'the service is busy', 'pending': state['pending'],
+                     'capacity': state['capacity']}
+    state['pending'] += len(jobs)
+    try:
+        results = await asyncio.gather(*[run_in_pool(state, i) for i in jobs])
+    finally:
+        state['pending'] -= len(jobs)
+    state['completed'] += len(jobs)
+    return 200, {'results': results} if batched else results[0]
+
+
+async def read_request(reader):
+    '''
+    Reads an HTTP request, returning its method, path and body, or an error
+    status and message.
+    '''
+    request_line = (await reader.readline()).decode('latin-1').split()
+    if len(request_line) != 3:
+        return None, None, None, (400, 'malformed request line')
+    method, path, version = request_line
+    headers = {}
+    while True:
+        line = (await reader.readline()).decode('latin-1').strip()
+        if not line:
+            break
+        name, _, value = line.partition(':')
+        headers[name.strip().lower()] = value.strip()
+    length = int(headers.get('content-length', 0))
+    if length > MAX_BODY:
+        return method, path, None, (413, 'the request body is too large')
+    body = await reader.readexactly(length) if length else b''
+    return method, path, body, None
+
+
+async def respond(state, reader):
+    try:
+        method, path, body, error = await asyncio.wait_for(read_request(reader), READ_TIMEOUT)
+    except (asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError):
+        return 400, {'error': 'incomplete request'}
+    if error is not None:
+        return error[0], {'error': error[1]}
+    if path == '/status':
+        if method != 'GET':
+            return 405, {'error': 'use GET for /status'}
+        return 200, {'workers': state['workers'], 'pending': state['pending'],
+                     'capacity': state['capacity'], 'completed': state['completed']}
+    if path == '/fit':
+        if method != 'POST':
+            return 405, {'error': 'use POST for /fit'}
+        try:
+            payload = json.loads(body.decode('utf-8'))
+        except ValueError as error:
+            return 400, {'error': 'invalid JSON: {0}'.format(error)}
+        return await fit_jobs(state, payload)
+    return 404, {'error': 'no such path: {0}'.format(path)}
+
+
+async def handle_connection(state, reader, writer):
+    '''
+    Answers one request per connection, then closes it.
+    '''
+    try:
+        status, reply = await respond(state, reader)
+    except Exception as error:
+        #Such as the pool breaking when a worker dies
+        status, reply = 500, {'error': '{0}: {1}'.format(type(error).__name__, error)}
+    body = json.dumps(reply).encode('utf-8')
+    header = 'HTTP/1.1 {0} {1}\r\nContent-Type: application/json\r\nContent-Length: {2}\r\n'.format(
+        status, REASONS[status], len(body))
+    if status == 503:
+        header += 'Retry-After: 1\r\n'
+    writer.write((header + 'Connection: close\r\n\r\n').encode('latin-1') + body)
+    try:
+        await writer.drain()
+    except ConnectionError:
+        pass
+    writer.close()
+
+
+async def run_service(host=HOST, port=PORT, socket_path=None, processes=1, queue_size=None):
+    from concurrent.futures import ProcessPoolExecutor
+    import signal
+
+    settings = {'precision_dps': ligfit.precision_dps, 'precision_mode': ligfit.precision_mode,
+                'precision_tolerance': ligfit.precision_tolerance}
+    executor = ProcessPoolExecutor(processes, initializer=warm_worker, initargs=(settings,))
+    loop = asyncio.get_running_loop()
+    #Start and warm every worker before taking any requests
+    await asyncio.gather(*[loop.run_in_executor(executor, ping) for i in range(processes)])
+    state = {'executor': executor, 'slots': asyncio.Semaphore(processes), 'workers': processes,
+             'capacity': processes + (processes if queue_size is None else queue_size),
+             'pending': 0, 'completed': 0}
+
+    def handler(reader, writer):
+        return handle_connection(state, reader, writer)
+    if socket_path:
+        server = await asyncio.start_unix_server(handler, path=socket_path)
+        address = socket_path
+    else:
+        server = await asyncio.start_server(handler, host, port)
+        address = '{0}:{1}'.format(host, server.sockets[0].getsockname()[1])
+    stop = asyncio.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop.set)
+    sys.stderr.write('serving fits on {0} with {1} workers\n'.format(address, processes))
+    sys.stderr.flush()
+    try:
+        async with server:
+            await stop.wait()
+    finally:
+        executor.shutdown(cancel_futures=True)
+        if socket_path and os.path.exists(socket_path):
+            os.remove(socket_path)
+
+
+def serve(host=HOST, port=PORT, socket_path=None, processes=1, queue_size=None):
+    '''
+    Runs the service until interrupted. By default as many jobs may wait as
+    there are workers.
+    '''
+    asyncio.run(run_service(host, port, socket_path, processes, queue_size))
+
+
+def request(path, payload=None, host=HOST, port=PORT, socket_path=None, timeout=None):
+    '''
+    Sends a request to a running service, a POST of the payload as JSON if
+    one is given and otherwise a GET, and returns the status and the decoded
+    reply.
+    '''
+    if socket_path:
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        connection.settimeout(timeout)
+        connection.connect(socket_path)
+    else:
+        connection = socket.create_connection((host, port), timeout=timeout)
+    body = b'' if payload is None else json.dumps(payload).encode('utf-8')
+    header = '{0} {1} HTTP/1.1\r\nHost: localhost\r\nContent-Type: application/json\r\n' \
+             'Content-Length: {2}\r\nConnection: close\r\n\r\n'.format(
+                 'GET' if payload is None else 'POST', path, len(body))
+    chunks = []
+    try:
+        connection.sendall(header.encode('latin-1') + body)
+        while True:
+            chunk = connection.recv(1 << 16)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    finally:
+        connection.close()
+    head, _, reply = b''.join(chunks).partition(b'\r\n\r\n')
+    return int(head.split()[1]), json.loads(reply.decode('utf-8'))
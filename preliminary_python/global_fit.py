@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Global fitting of a linked set of titration series, such as the same receptor
+titrated at several protein concentrations. Each of Kd, alpha and the scaling
+factor is either shared by every series or local to each one, and all of the
+series are solved as a single least squares problem.
+
+The Jacobian of a series involves only the shared parameters and its own
+local ones, so it is assembled as a sparse matrix and solved with an
+iterative (LSMR) trust region step. The cost then grows linearly with the
+number of series rather than quadratically. The covariance keeps to the same
+block structure, inverting the normal equations through the Schur complement
+of the shared parameters rather than as one dense matrix.
+"""
+
+import numpy
+
+from ligfit import get_plp_derivatives, solve_species
+
+PARAMETERS = ('kd', 'alpha', 'scaling')
+
+
+def parameter_layout(n_series, shared):
+    '''
+    Returns an (n_series, 3) array giving, for each series and each of Kd,
+    alpha and the scaling factor, the index of that parameter in the global
+    parameter vector. The shared parameters come first, then the local
+    parameters of each series in turn.
+    '''
+    unknown = set(shared) - set(PARAMETERS)
+    if unknown:
+        raise ValueError('Unknown shared parameters: {0}'.format(', '.join(sorted(unknown))))
+    local = [i for i in PARAMETERS if i not in shared]
+    n_shared = len(PARAMETERS) - len(local)
+    layout = numpy.empty((n_series, len(PARAMETERS)), dtype=int)
+    shared_index = 0
+    for j, name in enumerate(PARAMETERS):
+        if name in shared:
+            layout[:, j] = shared_index
+            shared_index += 1
+        else:
+            layout[:, j] = n_shared + numpy.arange(n_series) * len(local) + local.index(name)
+    return layout
+
+
+def series_jacobian(l_total, params, p_total):
+    '''
+    Returns the scaled [PLP] of one series and its Jacobian (M, 3) with
+    respect to the logarithms of Kd, alpha and the scaling factor.
+    '''
+    kd, alpha, scaling = params
+    species = solve_species(kd, alpha, p_total, l_total, scratch='global_fit')
+    p, plp = species[0], numpy.nan_to_num(species[2])
+    d_kd, d_alpha, d_p_total, d_l_total = get_plp_derivatives(kd, alpha, p_total, l_total, p)
+    jac = numpy.column_stack((scaling * kd * d_kd, scaling * alpha * d_alpha, scaling * plp))
+    return scaling * plp, numpy.nan_to_num(jac)
+
+
+def block_covariance(blocks, shared):
+    '''
+    Returns the blocks (N, 3, 3) of the pseudo-inverse of the normal
+    equations belonging to each series, given the contribution (N, 3, 3) of
+    each series to them in its own Kd, alpha and scaling. The shared
+    parameters couple the series only through the Schur complement
+    S = A - sum B D^-1 B^T of the shared block A of the summed contributions,
+    with B and D the shared-local and local blocks of each series, so only
+    3x3 systems are inverted however many series there are.
+    '''
+    shared = [j for j, name in enumerate(PARAMETERS) if name in shared]
+    local = [j for j in range(len(PARAMETERS)) if j not in shared]
+    a = blocks[:, shared][:, :, shared].sum(axis=0)
+    b = blocks[:, shared][:, :, local]
+    d_inv = numpy.linalg.pinv(blocks[:, local][:, :, local])
+    b_d_inv = numpy.matmul(b, d_inv)
+    s_inv = numpy.linalg.pinv(a - numpy.matmul(b_d_inv, b.transpose(0, 2, 1)).sum(axis=0))
+    cross = -1.0 * numpy.matmul(s_inv, b_d_inv)
+    cov = numpy.empty(blocks.shape)
+    cov[:, numpy.array(shared, int)[:, numpy.newaxis], shared] = s_inv
+    cov[:, numpy.array(shared, int)[:, numpy.newaxis], local] = cross
+    cov[:, numpy.array(local, int)[:, numpy.newaxis], shared] = cross.transpose(0, 2, 1)
+    cov[:, numpy.array(local, int)[:, numpy.newaxis], local] = d_inv + numpy.matmul(
+        b_d_inv.transpose(0, 2, 1), numpy.matmul(s_inv, b_d_inv))
+    return cov
+
+
+def fit_global(datasets, shared=('kd',), p0=None):
+    '''
+    Fits a linked set of series, each a tuple of (total_ligand, y_obs,
+    p_total), with the named parameters shared among all of them. p0 gives
+    the starting Kd, alpha and scaling of each series (N, 3); shared starting
+    values are taken as the geometric mean over the series.
+
+    Returns the parameters of each series (N, 3), their covariances
+    (N, 3, 3), and the sum of squared residuals of each series (N,).
+    '''
+    from scipy.optimize import least_squares
+    from scipy.sparse import coo_matrix
+
+    n_series = len(datasets)
+    layout = parameter_layout(n_series, shared)
+    n_params = layout.max() + 1
+    if p0 is None:
+        from start_values import estimate_start
+        p0 = [estimate_start(l_total, y, p_total) for l_total, y, p_total in datasets]
+    #Parameters are solved in log-space, which keeps them all positive
+    log_p0 = numpy.log(numpy.asarray(p0, numpy.float64))
+    x0 = numpy.zeros(n_params)
+    counts = numpy.zeros(n_params)
+    numpy.add.at(x0, layout, log_p0)
+    numpy.add.at(counts, layout, 1.0)
+    x0 /= counts
+
+    offsets = numpy.cumsum([0] + [len(i[0]) for i in datasets])
+
+    def residuals(x):
+        params = numpy.exp(x[layout])
+        res = numpy.empty(offsets[-1])
+        for k, (l_total, y, p_total) in enumerate(datasets):
+            kd, alpha, scaling = params[k]
+            plp = numpy.nan_to_num(solve_species(kd, alpha, p_total, l_total, scratch='global_fit')[2])
+            res[offsets[k]:offsets[k + 1]] = scaling * plp - y
+        return res
+
+    def jacobian(x):
+        params = numpy.exp(x[layout])
+        rows, cols, vals = [], [], []
+        for k, (l_total, y, p_total) in enumerate(datasets):
+            model, jac = series_jacobian(l_total, params[k], p_total)
+            n_points = len(l_total)
+            rows.append(numpy.repeat(numpy.arange(offsets[k], offsets[k + 1]), 3))
+            cols.append(numpy.tile(layout[k], n_points))
+            vals.append(jac.ravel())
+        #Repeated (row, column) pairs are summed, as they should be when a
+        #series shares several of its parameters
+        return coo_matrix((numpy.concatenate(vals), (numpy.concatenate(rows), numpy.concatenate(cols))),
+                          shape=(offsets[-1], n_params)).tocsr()
+
+    result = least_squares(residuals, x0, jac=jacobian, method='trf', tr_solver='lsmr', x_scale='jac')
+    params = numpy.exp(result.x[layout])
+
+    #Covariance of the log-parameters as curve_fit reports it, mapped back to
+    #the parameters of each series
+    jac = result.jac.tocsr()
+    blocks = numpy.empty((n_series, len(PARAMETERS), len(PARAMETERS)))
+    for k in range(n_series):
+        block = jac[offsets[k]:offsets[k + 1]][:, layout[k]].toarray()
+        blocks[k] = block.T.dot(block)
+    dof = max(offsets[-1] - n_params, 1)
+    pcov = block_covariance(blocks, shared) * (2.0 * result.cost / dof)
+    pcov = pcov * params[:, :, numpy.newaxis] * params[:, numpy.newaxis, :]
+    cost = numpy.array([numpy.sum(numpy.power(result.fun[offsets[k]:offsets[k + 1]], 2.0))
+                        for k in range(n_series)])
+    return params, pcov, cost
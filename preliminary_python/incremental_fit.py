@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Incremental refitting of a titration whose points arrive one concentration at
+a time, as from a plate reader, without refitting from scratch after each.
+
+An experiment is kept as a dict holding its data, the current Kd, alpha and
+scaling factor, and a quadratic (Gauss-Newton) summary of the least squares
+cost over the log-parameters: every point contributes the linearization of
+its residual at the parameters current when it was last evaluated. Adding
+rows evaluates the model and its Jacobian for the new rows only, adds them
+to the summary and takes a Newton step on it, which costs nothing further for
+the points already seen.
+
+The summary drifts from the true cost as the parameters move, so after each
+step a few of the earlier points are re-evaluated as a probe. A full re-solve
+of every point, started from the current parameters, is made only when the
+step is too long to trust, the probe disagrees with the summary, the mean
+squared residual has grown markedly (the new points no longer fit the same
+minimum), or the number of points has doubled since the last full solve. The
+doubling keeps the total work over a titration linear in its points. Once in
+every doubling the full solve also starts from values estimated afresh, so
+that a fit led astray by the first few points is recovered from.
+
+The residuals are weighted by the weighting column; the Y-errors are kept
+with the data but, as for fit_lsq, not used. The Y-observed are not
+normalized, which would change with every new maximum, so the scaling factor
+is in the units of the Y-observed.
+"""
+
+import numpy
+
+from ligfit import INPUT_COLUMNS, get_plp_derivatives, solve_species
+
+#Fewest points for a fit of the three parameters, and the number of earlier
+#points re-evaluated to check each incremental step
+MIN_POINTS = 4
+PROBE_POINTS = 8
+
+#Longest incremental step trusted (in natural log units of each parameter),
+#and the largest relative disagreement between the probed cost and its
+#quadratic prediction
+MAX_STEP = 0.5
+PROBE_TOLERANCE = 0.05
+
+#Growth of the mean squared residual since the last full solve beyond which
+#the new points are taken to no longer fit the same minimum
+COST_GROWTH = 2.0
+
+
+def new_experiment(p_total, guess=None):
+    '''
+    Returns the state of an experiment with no points yet, at the protein
+    concentration p_total and, optionally, with guesses of Kd and alpha (such
+    as those of an input file header) for the first fit.
+    '''
+    return {'p_total': float(p_total), 'guess': guess, 'data': numpy.empty((16, len(INPUT_COLUMNS))),
+            'jacobian': numpy.empty((16, 3)), 'offsets': numpy.empty(16), 'n_points': 0,
+            'params': None, 'summary': None, 'n_at_full_solve': 0, 'n_at_fresh_solve': 0,
+            'cost_at_full_solve': 0.0, 'full_solves': 0, 'updates': 0}
+
+
+def grow(state, n_points):
+    '''
+    Makes room for n_points in the arrays of an experiment, doubling their
+    capacity as needed so that appending stays linear overall.
+    '''
+    capacity = len(state['data'])
+    if n_points <= capacity:
+        return
+    while capacity < n_points:
+        capacity *= 2
+    for name in ('data', 'jacobian', 'offsets'):
+        grown = numpy.empty((capacity,) + state[name].shape[1:])
+        grown[:state['n_points']] = state[name][:state['n_points']]
+        state[name] = grown
+
+
+def linearize(data, params, p_total):
+    '''
+    Returns the weighted residuals of rows of data and their Jacobian (M, 3)
+    with respect to the logarithms of Kd, alpha and the scaling factor.
+    '''
+    kd, alpha, scaling = params
+    l_total, y_obs, y_err, weight = data.T
+    root_weight = numpy.sqrt(weight)
+    species = solve_species(kd, alpha, p_total, l_total, scratch='incremental_fit')
+    p, plp = species[0], numpy.nan_to_num(species[2])
+    d_kd, d_alpha, d_p_total, d_l_total = get_plp_derivatives(kd, alpha, p_total, l_total, p)
+    jac = numpy.column_stack((scaling * kd * d_kd, scaling * alpha * d_alpha, scaling * plp))
+    return root_weight * (scaling * plp - y_obs), numpy.nan_to_num(jac) * root_weight[:, numpy.newaxis]
+
+
+def summarize(offsets, jacobian):
+    '''
+    The quadratic summary (H, g, c) of the cost of linearized residuals,
+    each given by an offset and its Jacobian such that the residual at the
+    log-parameters x is offset + jacobian.x; the cost at x is then
+    x.H.x + 2 g.x + c.
+    '''
+    return jacobian.T.dot(jacobian), jacobian.T.dot(offsets), offsets.dot(offsets)
+
+
+def summary_cost(summary, theta):
+    hessian, gradient, constant = summary
+    return theta.dot(hessian).dot(theta) + 2.0 * gradient.dot(theta) + constant
+
+
+def usable(data, params, p_total):
+    '''
+    Whether a fit can start from the parameters: they are positive and
+    finite, and neither the model nor its derivatives overflow at the data,
+    as they do for the extreme parameters a handful of points can lead to.
+    '''
+    if not (numpy.all(params > 0) and numpy.all(numpy.isfinite(params))):
+        return False
+    with numpy.errstate(all='ignore'):
+        residuals, jacobian = linearize(data, params, p_total)
+        return bool(numpy.isfinite(residuals.dot(residuals)) and numpy.all(numpy.isfinite(jacobian.T.dot(jacobian))))
+
+
+def full_solve(state, fresh=True):
+    '''
+    Fits every point of the experiment and rebuilds the summary at the
+    solution. The fit starts from the current parameters and, if fresh is
+    set (or they are not usable), also from starting values estimated afresh, as
+    the earlier points may have led the current parameters far along one of
+    the flat ridges of the cost.
+    '''
+    from scipy.optimize import least_squares
+
+    data = state['data'][:state['n_points']]
+    p_total = state['p_total']
+    starts = [] if state['params'] is None or not usable(data, state['params'], p_total) else [state['params']]
+    if fresh or not starts:
+        from start_values import estimate_start
+        l_total, y_obs, y_err, weight = data.T
+        guess = numpy.array(estimate_start(l_total, y_obs, p_total, state['guess']))
+        if usable(data, guess, p_total):
+            starts.append(guess)
+    if not starts:
+        return False
+
+    def residuals(theta):
+        return linearize(data, numpy.exp(theta), p_total)[0]
+
+    def jacobian(theta):
+        return linearize(data, numpy.exp(theta), p_total)[1]
+
+    with numpy.errstate(all='ignore'):
+        results = [least_squares(residuals, numpy.log(i), jac=jacobian, method='trf', x_scale='jac')
+                   for i in starts]
+    result = min(results, key=lambda i: i.cost if numpy.isfinite(i.cost) else numpy.inf)
+    n_points = len(data)
+    state['params'] = numpy.exp(result.x)
+    state['offsets'][:n_points] = result.fun - result.jac.dot(result.x)
+    state['jacobian'][:n_points] = result.jac
+    state['summary'] = summarize(state['offsets'][:n_points], state['jacobian'][:n_points])
+    state['n_at_full_solve'] = n_points
+    if fresh:
+        state['n_at_fresh_solve'] = n_points
+    state['cost_at_full_solve'] = 2.0 * result.cost
+    state['full_solves'] += 1
+    return result.success
+
+
+def incremental_step(state, start):
+    '''
+    Adds the points from start onwards to the summary and takes a Newton step
+    on it. Returns whether the step can be trusted; if not the experiment is
+    left unchanged for a full solve.
+    '''
+    data = state['data'][start:state['n_points']]
+    theta = numpy.log(state['params'])
+    with numpy.errstate(all='ignore'):
+        residuals, jacobian = linearize(data, state['params'], state['p_total'])
+        offsets = residuals - jacobian.dot(theta)
+        summary = [a + b for a, b in zip(state['summary'], summarize(offsets, jacobian))]
+        hessian, gradient, constant = summary
+        if not (numpy.all(numpy.isfinite(hessian)) and numpy.all(numpy.isfinite(gradient))):
+            return False
+        step = -1.0 * numpy.linalg.lstsq(hessian, hessian.dot(theta) + gradient, rcond=None)[0]
+    if not numpy.all(numpy.isfinite(step)) or numpy.max(numpy.abs(step)) > MAX_STEP:
+        return False
+
+    #Probe earlier points spread along the titration, and the new ones, at
+    #the stepped parameters against their quadratic prediction
+    new_theta = theta + step
+    probe = numpy.unique(numpy.linspace(0, start - 1, min(PROBE_POINTS, start)).astype(int))
+    probe_offsets = numpy.concatenate((state['offsets'][probe], offsets))
+    probe_jacobian = numpy.concatenate((state['jacobian'][probe], jacobian))
+    predicted = summary_cost(summarize(probe_offsets, probe_jacobian), new_theta)
+    probe_data = numpy.concatenate((state['data'][probe], data))
+    with numpy.errstate(all='ignore'):
+        actual = numpy.sum(numpy.power(linearize(probe_data, numpy.exp(new_theta), state['p_total'])[0], 2.0))
+    if not numpy.isfinite(actual) or abs(actual - predicted) > PROBE_TOLERANCE * max(actual, predicted, 1e-300):
+        return False
+    mean_cost = summary_cost(summary, new_theta) / state['n_points']
+    if mean_cost > COST_GROWTH * state['cost_at_full_solve'] / state['n_at_full_solve']:
+        return False
+
+    state['offsets'][start:state['n_points']] = offsets
+    state['jacobian'][start:state['n_points']] = jacobian
+    state['summary'] = tuple(summary)
+    state['params'] = numpy.exp(new_theta)
+    state['updates'] += 1
+    return True
+
+
+def add_points(state, rows):
+    '''
+    Appends rows of (total ligand, Y-observed, Y-error, weighting) to an
+    experiment and refits it, incrementally where that can be trusted.
+    Returns how it was refitted: 'waiting' while there are too few points
+    (or no start for a fit yet), 'update' or 'full', or 'failed' when the
+    full solve found no usable start (the experiment keeps its earlier fit)
+    or did not converge (it keeps the unconverged one).
+    '''
+    rows = numpy.atleast_2d(numpy.asarray(rows, numpy.float64))
+    if rows.shape[1] != len(INPUT_COLUMNS):
+        raise ValueError('Each row must hold {0}'.format(', '.join(INPUT_COLUMNS)))
+    start = state['n_points']
+    grow(state, start + len(rows))
+    state['data'][start:start + len(rows)] = rows
+    state['n_points'] += len(rows)
+    if state['n_points'] < MIN_POINTS:
+        return 'waiting'
+    if (state['summary'] is not None and state['n_points'] < 2 * state['n_at_full_solve']
+            and incremental_step(state, start)):
+        return 'update'
+    #A full solve forced by the step or the probe starts from the current
+    #parameters alone, but one in every doubling of the points also afresh
+    if full_solve(state, fresh=state['n_points'] >= 2 * state['n_at_fresh_solve']):
+        return 'full'
+    return 'failed' if state['summary'] is not None else 'waiting'
+
+
+def experiment_fit(state):
+    '''
+    Returns the current parameters of an experiment and their covariance,
+    estimated from the summary as curve_fit would from the Jacobian.
+    '''
+    if state['params'] is None:
+        raise ValueError('The experiment has fewer than {0} points'.format(MIN_POINTS))
+    hessian, gradient, constant = state['summary']
+    theta = numpy.log(state['params'])
+    dof = max(state['n_points'] - 3, 1)
+    cov = numpy.linalg.pinv(hessian) * (max(summary_cost(state['summary'], theta), 0.0) / dof)
+    return state['params'].copy(), cov * numpy.outer(state['params'], state['params'])
+
+
+def read_new_rows(file_path, position=None):
+    '''
+    Reads the rows appended to an input file since the given position (the
+    end of the header when None), returning them with the position to read
+    from next time. A last line not yet ended by a newline is left for then.
+    '''
+    with open(file_path, 'rb') as input_file:
+        if position is None:
+            for i in range(4):
+                input_file.readline()
+        else:
+            input_file.seek(position)
+        text = input_file.read()
+        position = input_file.tell()
+    complete = text.rfind(b'\n') + 1
+    position -= len(text) - complete
+    lines = [i for i in text[:complete].decode('utf-8').splitlines() if i.strip()]
+    rows = numpy.array([i.split()[:len(INPUT_COLUMNS)] for i in lines], numpy.float64)
+    return rows.reshape(-1, len(INPUT_COLUMNS)), position
@@ -19,12 +19,10 @@ Options:
 """
 
 from docopt import docopt  # Used for command-line argument parsing
-import scipy  # Used for fitting algorithms
 import mpmath
 from mpmath import mp, mpf  # Used for arbitrary precision floats
 import numpy  # Used for arrays
 import json  # Used to store/retrieve input information
-import matplotlib.pyplot as plt
 
 #mpmath.mp.precision
 
@@ -105,6 +103,13 @@ def calc_qr(a, b, c):
     return q, r
 
 
+#Element-wise mpmath functions for object arrays. The cube root must be the
+#real one, mpmath.cbrt returns the principal (complex) root of a negative value
+acos = numpy.frompyfunc(mpmath.acos, 1, 1)
+cos = numpy.frompyfunc(mpmath.cos, 1, 1)
+cbrt = numpy.frompyfunc(lambda x: mpmath.sign(x) * mpmath.cbrt(abs(x)), 1, 1)
+
+
 def cartesian_cubic(a, q, r):
     '''
     The cartesian coordinate solution of the cubic function; for use when
@@ -114,9 +119,10 @@ def cartesian_cubic(a, q, r):
     precision and numpy arrays.
     '''
     #Calculate the three terms of the cubic
+    root = numpy.power(numpy.power(q, mpf('3')) + numpy.power(r, mpf('2')), mpf('0.5'))
     first = a / mpf('-3')
-    second = numpy.power(r + numpy.power(numpy.power(q, mpf('3')) + numpy.power(r, mpf('2')), mpf('0.5')), mpf('1/3'))
-    third = numpy.power(r - numpy.power(numpy.power(q, mpf('3')) + numpy.power(r, mpf('2')), mpf('0.5')), mpf('1/3'))
+    second = cbrt(r + root)
+    third = cbrt(r - root)
     return first + second + third
 
 
@@ -128,8 +134,29 @@ def polar_cubic(a, q, r):
     This version formulated to work with mpmath for arbitrary floating point
     precision and numpy arrays.
     '''
-    theta = mpmath.acos(r / numpy.power(mpf('-1') * numpy.power(q, mpf('3')), mpf('0.5')))
-    return mpmath.cos(theta / mpf('3')) * numpy.power(mpf('-1') * q, mpf('0.5')) * mpf('2') - a / mpf('3')
+    cos_theta = r / numpy.power(mpf('-1') * numpy.power(q, mpf('3')), mpf('0.5'))
+    cos_theta = numpy.minimum(numpy.maximum(cos_theta, mpf('-1')), mpf('1'))
+    theta = acos(cos_theta)
+    return cos(theta / mpf('3')) * numpy.power(mpf('-1') * q, mpf('0.5')) * mpf('2') - a / mpf('3')
+
+
+def solve_cubic(a, q, r):
+    '''
+    Solves the cubic for [P]-free over whole arrays at once. The discriminant
+    Q^3+R^2 is computed a single time and each of the cartesian and polar
+    solutions is evaluated only on the points selected by its mask.
+
+    This version formulated to work with mpmath for arbitrary floating point
+    precision and numpy arrays.
+    '''
+    a, q, r = numpy.broadcast_arrays(*[numpy.asarray(i, dtype=object) for i in (a, q, r)])
+    disc = numpy.power(q, mpf('3')) + numpy.power(r, mpf('2'))
+    cartesian = numpy.asarray(disc > mpf('0'), dtype=bool)
+    polar = ~cartesian
+    p = numpy.empty(disc.shape, dtype=object)
+    p[cartesian] = cartesian_cubic(a[cartesian], q[cartesian], r[cartesian])
+    p[polar] = polar_cubic(a[polar], q[polar], r[polar])
+    return p
 
 
 def get_pl(kd, alpha, l_total, p):
@@ -159,13 +186,7 @@ def get_plp(kd, alpha, l_total, p):
 def model_func(kd, alpha, p_total, l_total):
     a, b, c = calc_abc(kd, alpha, p_total, l_total)
     q, r = calc_qr(a, b, c)
-    p = []
-    for a_val, q_val, r_val in zip(a, q, r):
-        if numpy.power(q_val, mpf('3')) + numpy.power(r_val, mpf('2')) > mpf('0'):
-            p.append(cartesian_cubic(a_val, q_val, r_val))
-        else:
-            p.append(polar_cubic(a_val, q_val, r_val))
-    p = numpy.array(p)
+    p = solve_cubic(a, q, r)
     pl = get_pl(kd, alpha, l_total, p)
     plp = get_plp(kd, alpha, l_total, p)
     return p, pl, plp
@@ -208,6 +229,7 @@ def fit():
     #p, pl, plp = model_func(kd, alpha, p_total, ligand_range)
 
 
+    #import matplotlib.pyplot as plt
     #plt.plot(ligand_range, p / p_total, label='[P]')
     #plt.plot(ligand_range, pl / p_total, label='[PL]')
     #plt.plot(ligand_range, plp / p_total, label='[PLP]')
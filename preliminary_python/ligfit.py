@@ -4,27 +4,126 @@
 """LigFit
 
 Usage:
-  ligfit.py fit <input> [<output>] (--lsq | --odr) [--precision=<dps>]
+  ligfit.py fit <input> [<output>] (--lsq [--approximate] | --odr)
+                [--precision=<dps>]
+                [--precision-mode=<mode>] [--tolerance=<tol>]
+                [--no-plot | --plot-to=<file>] [--telemetry=<json>]
+                [--bootstrap=<n> [--resample=<from>] [--processes=<n>]]
+  ligfit.py surface <input> [<output>] [--kd-range=<range>]
+                [--alpha-range=<range>] [--scaling=<s>]
+  ligfit.py batch <inputs>... [--output=<table>] [--processes=<n> | --stacked]
+  ligfit.py global <inputs>... [--output=<table>] [--shared=<names>]
+  ligfit.py multistart <input> [--output=<table>] [--starts=<n>]
+                [--consensus=<n>] [--kd-box=<range>] [--alpha-box=<range>]
+                [--processes=<n>] [--seed=<n>]
+  ligfit.py serve [--host=<host>] [--port=<port> | --socket=<path>]
+                [--processes=<n>] [--queue=<n>] [--precision=<dps>]
+                [--precision-mode=<mode>] [--tolerance=<tol>]
   ligfit.py makeinput [<filename>]
 
 Options:
   -l --lsq             fit using least squares (error only in Y)
   -o --odr             fit using orthogonal distance regression, error in all
                        axes
+  --approximate        fit against the interpolated solution table rather
+                       than the exact model: fast, but only as accurate as
+                       the table (a few parts in a thousand)
   --precision=<dps>    specify the decimal place precision for calculations
+  --precision-mode=<mode>
+                       escalate inaccurate points to longdouble,
+                       double-double or straight to mpmath [default: longdouble]
+  --tolerance=<tol>    relative error in [P]-free beyond which a point is
+                       escalated to higher precision; the result is float64,
+                       so below 1.1e-16 every point reaches mpmath
+                       [default: 1e-10]
+  --no-plot            fit without plotting, for use without a display
+  --plot-to=<file>     save the plot to a file (its format given by the
+                       extension) instead of showing it
+  --telemetry=<json>   write counts and timings of the model evaluations and
+                       the optimizer outcome of the fit to a JSON file
+  --bootstrap=<n>      refit n bootstrap replicates of the data by least
+                       squares and report 95% percentile intervals
+  --resample=<from>    draw the bootstrap replicates from the fit residuals
+                       or from the Y-errors [default: residuals]
+  --kd-range=<range>   log10 Kd grid of a chi-square surface, as first,last,
+                       count [default: -2,6,81]
+  --alpha-range=<range>
+                       log10 alpha grid of a chi-square surface, as first,
+                       last,count [default: -2,8,101]
+  --scaling=<s>        fix the scaling factor of a chi-square surface rather
+                       than profiling it out
+  --output=<table>     write the batch, global or multistart results table
+                       to a file instead of standard output
+  --processes=<n>      number of worker processes for batch, bootstrap or
+                       multistart fitting, or of the fitting service
+                       [default: all cores]
+  --stacked            fit all batch inputs together with the stacked
+                       Levenberg-Marquardt solver instead of a process pool
+  --shared=<names>     comma-separated parameters (kd, alpha, scaling) shared
+                       by all series of a global fit [default: kd]
+  --starts=<n>         most local fits of a multistart search [default: 80]
+  --consensus=<n>      stop a multistart search once this many fits have
+                       reached the lowest minimum [default: 5]
+  --kd-box=<range>     log10 Kd edges of the boxes multistart starts are
+                       drawn from, as first,last,count [default: -2,6,9]
+  --alpha-box=<range>  log10 alpha edges of the boxes multistart starts are
+                       drawn from, as first,last,count [default: -2,8,11]
+  --seed=<n>           seed of the multistart starts
+  --host=<host>        address the fitting service listens on
+                       [default: 127.0.0.1]
+  --port=<port>        TCP port of the fitting service [default: 8765]
+  --socket=<path>      listen on a Unix socket instead of a TCP port
+  --queue=<n>          fit jobs that may wait for a worker before the service
+                       refuses more (by default as many as the workers)
   -h --help            show this help message and exit
   -v --version         show version and exit
   -q --quiet           report only file names
 
 """
 
+#scipy, matplotlib, mpmath and multiprocessing are imported where they are
+#used, so that starting up (and commands which never need them) stays quick
 from docopt import docopt  # Used for command-line argument parsing
-from scipy.optimize import curve_fit
 import numpy  # Used for arrays
 import json  # Used to store/retrieve input information
-import matplotlib.pyplot as plt
+import collections
+import hashlib
+import glob  # Used to expand batch input patterns
+import os
+import sys
+import time
 
-#mpmath.mp.precision
+import telemetry  # Opt-in instrumentation of the model and fits
+
+#Working precision (decimal places) of the points escalated to mpmath, set
+#with --precision
+precision_dps = 30
+
+#Arithmetic that the points failing the tolerance in float64 are escalated to
+#before mpmath, set with --precision-mode
+PRECISION_MODES = ('longdouble', 'double-double', 'mpmath')
+precision_mode = 'longdouble'
+
+#Relative error in [P]-free above which a point is re-evaluated at a higher
+#precision, set with --tolerance
+PRECISION_TOLERANCE = 1e-10
+precision_tolerance = PRECISION_TOLERANCE
+
+#Number of recent model evaluations kept by model_species
+MODEL_CACHE_SIZE = 256
+
+#Number of scratch buffers kept by workspace, one per name, shape and dtype
+WORKSPACE_SIZE = 32
+
+#Whether solve_species (and so model_species) uses the fused kernel of
+#compiled_kernel.py where numba is installed (it falls back to NumPy otherwise)
+use_compiled = True
+
+#Protein concentration assumed for input files without prot_total
+DEFAULT_P_TOTAL = 0.1
+
+#The rows of the array returned by get_species
+SPECIES = ('p', 'pl', 'plp', 'l_free')
 
 #Configuration of input() for support in both Python 2 and Python 3
 try:
@@ -33,23 +132,127 @@ except NameError:
     pass
 
 
-def parse_input_file(file_path):
+#Binary sidecar written next to a parsed input file, so that later fits of the
+#same data load its columns without parsing any text
+SIDECAR_SUFFIX = '.lfb'
+SIDECAR_MAGIC = b'LIGFITB1'
+SIDECAR_ALIGN = 64
+INPUT_COLUMNS = ('total_ligand', 'y_obs', 'y_err', 'weight')
+
+
+def parse_input_file(file_path, use_mpf=False, cache=True):
+    '''
+    Reads an input file, returning the fitting parameters from its JSON
+    header and the data as a list of arrays: total ligand, Y-observed, Y-error
+    and weighting. The numeric block is parsed in bulk (any whitespace may
+    separate the values) straight into float64 arrays, or into arrays of mpf
+    when use_mpf is set.
+
+    For float64 data a binary sidecar is kept alongside the input file, and is
+    used in place of the text for as long as the input file is unchanged.
+    '''
+    if not use_mpf:
+        if cache:
+            sidecar = read_sidecar(file_path)
+            if sidecar is not None:
+                return sidecar
     with open(file_path, 'r') as input_file:
-        input_lines = input_file.readlines()
+        input_file.readline()
         #Load the JSON string on the second line, parse it
-        fitting_params = json.loads(input_lines[1])
-        #Parse the space-delimited data
-        total_ligand, y_obs, y_err, weight = [], [], [], []
-        for data_line in input_lines[4:]:
-            vals = data_line.split(' ')
-            total_ligand.append(vals[0])
-            y_obs.append(vals[1])
-            y_err.append(vals[2])
-            weight.append(vals[3])
-    data = [numpy.array(i, numpy.float64) for i in [total_ligand, y_obs, y_err, weight]]
+        fitting_params = json.loads(input_file.readline())
+        input_file.readline()
+        input_file.readline()
+        #Parse the whitespace-delimited data in bulk
+        dtype = str if use_mpf else numpy.float64
+        values = numpy.loadtxt(input_file, dtype=dtype, ndmin=2, usecols=range(len(INPUT_COLUMNS)))
+    if use_mpf:
+        import mpmath
+        with mpmath.workdps(precision_dps):
+            data = [numpy.array([mpmath.mpf(j) for j in i], dtype=object) for i in values.T]
+        return fitting_params, data
+    data = list(numpy.ascontiguousarray(values.T))
+    if cache:
+        try:
+            write_sidecar(file_path, fitting_params, data)
+        except (IOError, OSError):
+            pass
     return fitting_params, data
 
 
+def write_sidecar(file_path, fitting_params, data):
+    '''
+    Writes the binary sidecar of an input file: a magic string, the length of
+    a JSON header (the fitting parameters, the size and modification time of
+    the input file and the layout of the data) and then, aligned for memory
+    mapping, the raw float64 columns one after another.
+
+    The sidecar is written to a temporary file and renamed into place, so
+    that a process reading (or mapping) the old one never sees it truncated.
+    '''
+    import tempfile
+    stat = os.stat(file_path)
+    header = json.dumps({'fitting_params': fitting_params,
+                         'source_size': stat.st_size,
+                         'source_mtime_ns': stat.st_mtime_ns,
+                         'columns': list(INPUT_COLUMNS),
+                         'rows': len(data[0]),
+                         'dtype': '<f8'}).encode('utf-8')
+    offset = len(SIDECAR_MAGIC) + 8 + len(header)
+    padding = -offset % SIDECAR_ALIGN
+    sidecar_path = file_path + SIDECAR_SUFFIX
+    descriptor, temporary_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(sidecar_path)),
+                                                  suffix=SIDECAR_SUFFIX + '.tmp')
+    try:
+        with os.fdopen(descriptor, 'wb') as out:
+            out.write(SIDECAR_MAGIC)
+            out.write(numpy.array(len(header) + padding, '<u8').tobytes())
+            out.write(header + b' ' * padding)
+            for column in data:
+                out.write(numpy.asarray(column, '<f8').tobytes())
+        os.replace(temporary_path, sidecar_path)
+    except BaseException:
+        os.remove(temporary_path)
+        raise
+
+
+def read_sidecar(file_path):
+    '''
+    Returns the fitting parameters and memory-mapped columns from the binary
+    sidecar of an input file, or None (to parse the input file instead) if
+    there is no sidecar, the input file has changed since it was written, or
+    its header or size do not match its layout.
+    '''
+    sidecar_path = file_path + SIDECAR_SUFFIX
+    try:
+        with open(sidecar_path, 'rb') as sidecar:
+            if sidecar.read(len(SIDECAR_MAGIC)) != SIDECAR_MAGIC:
+                return None
+            header_length = int(numpy.frombuffer(sidecar.read(8), '<u8')[0])
+            header = json.loads(sidecar.read(header_length).decode('utf-8'))
+            sidecar_size = os.fstat(sidecar.fileno()).st_size
+        stat = os.stat(file_path)
+        offset = len(SIDECAR_MAGIC) + 8 + header_length
+        shape = (len(header['columns']), header['rows'])
+        if ((header['source_size'], header['source_mtime_ns']) != (stat.st_size, stat.st_mtime_ns)
+                or header['columns'] != list(INPUT_COLUMNS)
+                or sidecar_size != offset + shape[0] * shape[1] * numpy.dtype(header['dtype']).itemsize):
+            return None
+        if header['rows'] == 0:
+            return header['fitting_params'], list(numpy.zeros(shape))
+        columns = numpy.memmap(sidecar_path, dtype=header['dtype'], mode='r', shape=shape, offset=offset)
+    except (IOError, OSError, ValueError, IndexError, KeyError, TypeError):
+        return None
+    return header['fitting_params'], list(columns)
+
+
+def parse_input_files(file_paths):
+    '''
+    Parses a linked set of input files, such as one series per protein
+    concentration, returning a list of (fitting_params, data) in order.
+    '''
+    return [parse_input_file(file_path) for file_path in file_paths]
+
+
 def make_input_file():
     #If the filename was not specified at command, ask for it
     if arguments['<filename>'] is None:
@@ -75,6 +278,7 @@ format in the following order:
 <Your Data Here>''')
 
 
+@telemetry.timed('calc_abc')
 def calc_abc(kd, alpha, p_total, l_total):
     '''
     Calculates the cubic polynomial constants a, b, and c from the given Kd,
@@ -86,6 +290,7 @@ def calc_abc(kd, alpha, p_total, l_total):
     return a, b, c
 
 
+@telemetry.timed('calc_qr')
 def calc_qr(a, b, c):
     '''
     Calculates Q and R (functions of a, b, and c) for the cubic solution. The
@@ -102,10 +307,12 @@ def cartesian_cubic(a, q, r):
     The cartesian coordinate solution of the cubic function; for use when
     Q^3+R^2 > 0
     '''
-    #Calculate the three terms of the cubic
+    #Calculate the three terms of the cubic, the real cube root is required as
+    #R - sqrt(Q^3 + R^2) is negative whenever Q > 0
+    root = numpy.sqrt(numpy.power(q, 3.0) + numpy.power(r, 2.0))
     first = a / -3.0
-    second = numpy.power(r + numpy.sqrt(numpy.power(q, 3) + numpy.power(r, 2)), 1.0 / 3.0)
-    third = numpy.power(r - numpy.sqrt(numpy.power(q, 3) + numpy.power(r, 2)), 1.0 / 3.0)
+    second = numpy.cbrt(r + root)
+    third = numpy.cbrt(r - root)
     return first + second + third
 
 
@@ -114,11 +321,207 @@ def polar_cubic(a, q, r):
     The polar coordinate solution of the cubic function; for use when
     Q^3+R^2 < 0
     '''
-    theta = numpy.arccos(r / numpy.sqrt(-1.0 * numpy.power(q, 3.0)))
+    #Rounding may push the cosine argument just outside of [-1, 1]
+    cos_theta = numpy.clip(r / numpy.sqrt(-1.0 * numpy.power(q, 3.0)), -1.0, 1.0)
+    theta = numpy.arccos(cos_theta)
     val = numpy.cos(theta / 3.0) * numpy.sqrt(-1.0 * q) * 2.0 - a / 3.0
     return val
 
 
+@telemetry.timed('solve_cubic')
+def solve_cubic(a, q, r):
+    '''
+    Solves the cubic for [P]-free over whole arrays at once. The discriminant
+    Q^3+R^2 is computed a single time and each of the cartesian and polar
+    solutions is evaluated only on the points selected by its mask.
+    '''
+    a, q, r = numpy.broadcast_arrays(a, q, r)
+    disc = numpy.power(q, 3.0) + numpy.power(r, 2.0)
+    cartesian = disc > 0
+    polar = ~cartesian
+    if telemetry.enabled:
+        telemetry.count('cartesian_points', numpy.count_nonzero(cartesian))
+        telemetry.count('polar_points', numpy.count_nonzero(polar))
+    p = numpy.empty_like(disc)
+    p[cartesian] = cartesian_cubic(a[cartesian], q[cartesian], r[cartesian])
+    p[polar] = polar_cubic(a[polar], q[polar], r[polar])
+    return p
+
+
+@telemetry.timed('polish_root')
+def polish_root(kd, alpha, p_total, l_total, p, iterations=2, max_iterations=100):
+    '''
+    Refines the closed-form [P]-free with Halley iterations on the cubic
+    P^3 + aP^2 + bP + c itself, keeping each point within the physical
+    interval [0, p_total]. Every point takes at least the given number of
+    iterations; a point whose closed form was far off (as when the final sum
+    with -a/3 cancels) continues, bracketed by the sign of the cubic and
+    falling back to bisection, until its step is down to rounding.
+
+    Returns the polished [P]-free and, for each point, an a-posteriori bound
+    on its relative error from the residual of the cubic and the rounding of
+    a, b and c, or from the last step where that is larger.
+    '''
+    #Scalar parameters with an array of l_total (or of p) work as they do
+    #for the other model helpers
+    kd, alpha, p_total, l_total, p = numpy.broadcast_arrays(kd, alpha, p_total, l_total, p)
+    a, b, c = calc_abc(kd, alpha, p_total, l_total)
+    p = numpy.array(p, dtype=a.dtype)
+    eps = numpy.finfo(p.dtype).eps
+    shape = p.shape
+    a, b, c, p_total, p = [numpy.ravel(i) for i in (a, b, c, p_total, p)]
+    with numpy.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        p = numpy.where((p > 0) & (p < p_total), p, 0.5 * p_total)
+        step = numpy.full_like(p, numpy.inf)
+        #Only the points still moving are iterated, on compacted copies
+        active = numpy.arange(p.size)
+        lower, upper = numpy.zeros_like(p), p_total.copy()
+        for iteration in range(max_iterations):
+            x, xa, xb = p[active], a[active], b[active]
+            f = ((x + xa) * x + xb) * x + c[active]
+            df = (3.0 * x + 2.0 * xa) * x + xb
+            ddf = 6.0 * x + 2.0 * xa
+            low = numpy.where(f < 0, x, lower[active])
+            high = numpy.where(f > 0, x, upper[active])
+            new = x - 2.0 * f * df / (2.0 * df * df - f * ddf)
+            #Bisect (geometrically, once the bracket is away from 0) whenever
+            #the Halley step would leave the bracket
+            middle = numpy.where(low > 0, numpy.sqrt(low * high), 0.5 * (low + high))
+            new = numpy.where((new > low) & (new < high), new, middle)
+            new = numpy.where(f == 0, x, new)
+            lower[active], upper[active] = low, high
+            p[active] = new
+            step[active] = numpy.abs(new - x)
+            if iteration + 1 >= iterations:
+                active = active[step[active] > 4.0 * eps * new]
+                if active.size == 0:
+                    break
+
+        p_sq = numpy.power(p, 2.0)
+        f = ((p + a) * p + b) * p + c
+        df = (3.0 * p + 2.0 * a) * p + b
+        kd, alpha, l_total = [numpy.ravel(i) for i in (kd, alpha, l_total)]
+        #The size of the terms of the cubic, with a, b and c expanded so that
+        #any cancellation in forming them is counted
+        magnitude = (p_sq * p + (2.0 * kd / alpha + 2.0 * l_total + p_total) * p_sq
+                     + (kd + 2.0 * l_total + 2.0 * p_total) * (kd / alpha) * p
+                     + numpy.power(kd, 2.0) * p_total / alpha)
+        error = numpy.fmax((numpy.abs(f) + 8.0 * eps * magnitude) / numpy.abs(df * p), step / p)
+        error = numpy.where((p > 0) & (p <= p_total), error, numpy.inf)
+        error = numpy.where(numpy.isnan(error), numpy.inf, error)
+    return p.reshape(shape), error.reshape(shape)
+
+
+def solve_cubic_mp(a, q, r):
+    '''
+    Solves the cubic for [P]-free at a single point of mpf values, with the
+    same cartesian or polar solution as solve_cubic, at the mpmath working
+    precision.
+    '''
+    import mpmath
+    from mpmath import mpf
+    disc = q ** 3 + r ** 2
+    if disc > 0:
+        root = mpmath.sqrt(disc)
+        cbrt = lambda x: mpmath.sign(x) * mpmath.cbrt(abs(x))
+        return a / mpf('-3') + cbrt(r + root) + cbrt(r - root)
+    cos_theta = min(max(r / mpmath.sqrt(-q ** 3), mpf('-1')), mpf('1'))
+    theta = mpmath.acos(cos_theta)
+    return mpmath.cos(theta / mpf('3')) * mpmath.sqrt(-q) * mpf('2') - a / mpf('3')
+
+
+def polish_root_mp(p, kd, alpha, p_total, l_total, max_iterations=100):
+    '''
+    Solves the cubic for [P]-free at a single point of mpf values at the
+    mpmath working precision, refining the closed form by Newton steps until
+    they stop changing it; the float64 root p is the start instead if the
+    closed form lies outside (0, p_total]. Returns the root as a float and a
+    bound on its relative error, from the residual of the cubic and the final
+    rounding to float64.
+    '''
+    import mpmath
+    a, b, c = calc_abc(kd, alpha, p_total, l_total)
+    q, r = calc_qr(a, b, c)
+    root = solve_cubic_mp(a, q, r)
+    if not 0 < root <= p_total:
+        root = mpmath.mpf(float(p))
+    for i in range(max_iterations):
+        df = (3 * root + 2 * a) * root + b
+        if df == 0:
+            break
+        step = (((root + a) * root + b) * root + c) / df
+        root -= step
+        if abs(step) <= abs(root) * mpmath.eps:
+            break
+    f = ((root + a) * root + b) * root + c
+    df = (3 * root + 2 * a) * root + b
+    if root == 0 or df == 0:
+        return float(root), numpy.inf
+    return float(root), float(abs(f / (df * root))) + 0.5 * numpy.finfo(numpy.float64).eps
+
+
+@telemetry.timed('free_protein')
+def free_protein(kd, alpha, p_total, l_total, tolerance=None):
+    '''
+    Returns [P]-free, solving in float64 and polishing the closed form with
+    polish_root. Only the points whose error bound still exceeds the tolerance
+    (by default precision_tolerance) are escalated: first as precision_mode
+    selects, to extended precision (where numpy.longdouble offers it) or to
+    double-double, and then to mpmath at precision_dps.
+    '''
+    if tolerance is None:
+        tolerance = precision_tolerance
+    kd, alpha, p_total, l_total = numpy.broadcast_arrays(kd, alpha, p_total, l_total)
+    a, b, c = calc_abc(kd, alpha, p_total, l_total)
+    q, r = calc_qr(a, b, c)
+    p, error = polish_root(kd, alpha, p_total, l_total, solve_cubic(a, q, r))
+    flagged = numpy.asarray(error > tolerance)
+    if telemetry.enabled:
+        telemetry.count('points', p.size)
+    if not flagged.any():
+        return p
+
+    #Both escalations round their root back to the float64 of p, so the
+    #bound kept for it includes the half ulp of that rounding
+    extended = numpy.longdouble
+    rounding = 0.5 * numpy.finfo(p.dtype).eps
+    if precision_mode == 'double-double':
+        if telemetry.enabled:
+            telemetry.count('escalated_double_double', numpy.count_nonzero(flagged))
+        from double_double import free_protein_dd
+        args = [i[flagged] for i in (kd, alpha, p_total, l_total)]
+        p_dd, error_dd = free_protein_dd(*args, p=p[flagged])
+        p[flagged] = p_dd[0]
+        error[flagged] = error_dd + rounding
+        flagged[flagged] = error[flagged] > tolerance
+    elif precision_mode == 'longdouble' and numpy.finfo(extended).eps < numpy.finfo(p.dtype).eps:
+        if telemetry.enabled:
+            telemetry.count('escalated_longdouble', numpy.count_nonzero(flagged))
+        args = [i[flagged].astype(extended) for i in (kd, alpha, p_total, l_total)]
+        a, b, c = calc_abc(*args)
+        q, r = calc_qr(a, b, c)
+        p_ext, error_ext = polish_root(*(args + [solve_cubic(a, q, r)]))
+        p[flagged] = p_ext
+        error[flagged] = error_ext + rounding
+        flagged[flagged] = error[flagged] > tolerance
+
+    if not flagged.any():
+        return p
+    if telemetry.enabled:
+        telemetry.count('escalated_mpmath', numpy.count_nonzero(flagged))
+    import mpmath
+    with mpmath.workdps(precision_dps):
+        for index in map(tuple, numpy.argwhere(flagged)):
+            args = [mpmath.mpf(float(i[index])) for i in (kd, alpha, p_total, l_total)]
+            p_mp, error_mp = polish_root_mp(p[index], *args)
+            #The closed form can cancel even at this precision, so the root is
+            #only kept where it is physical and better than the one it replaces
+            if 0 < p_mp <= args[2] and error_mp < error[index]:
+                p[index] = p_mp
+    return p
+
+
+@telemetry.timed('get_pl')
 def get_pl(kd, alpha, l_total, p):
     '''
     After solving for [P]-free, this function will return the concentration of
@@ -128,6 +531,7 @@ def get_pl(kd, alpha, l_total, p):
     denominator = numpy.power(kd, 2.0) + 2.0 * kd * p + alpha * numpy.power(p, 2.0)
     return numerator / denominator
 
+@telemetry.timed('get_plp')
 def get_plp(kd, alpha, l_total, p):
     '''
     After solving for [P]-free, this function will return the concentration of
@@ -137,67 +541,398 @@ def get_plp(kd, alpha, l_total, p):
     denominator = numpy.power(kd, 2.0) + 2.0 * kd * p + alpha * numpy.power(p, 2.0)
     return numerator / denominator
 
-def model_func(kd, alpha, p_total, l_total):
+@telemetry.timed('get_species')
+def get_species(kd, alpha, l_total, p, out=None, work=None):
+    '''
+    After solving for [P]-free, returns [P], [PL], [PLP] and free ligand
+    together as the rows of one array (4, ...) in the order of SPECIES,
+    sharing the denominator Kd^2 + 2 Kd P + alpha P^2 and L_total/D between
+    them. The mass balance of the ligand gives free ligand as
+    L_total - [PL] - [PLP] = Kd^2 L_total/D.
+
+    The result is written into out and the intermediates into work (2, ...)
+    when these are given, so that with both a repeated evaluation, such as
+    within an optimizer, allocates nothing.
+    '''
+    p = numpy.asarray(p)
+    shape = numpy.broadcast(kd, alpha, l_total, p).shape
+    dtype = numpy.result_type(kd, alpha, l_total, p, 1.0)
+    if out is None:
+        out = numpy.empty((len(SPECIES),) + shape, dtype)
+    if work is None:
+        work = numpy.empty((2,) + shape, dtype)
+    alpha_p_sq, ratio = work
+    #D = Kd (Kd + 2P) + alpha P^2, then L_total/D
+    numpy.multiply(p, p, out=alpha_p_sq)
+    numpy.multiply(alpha_p_sq, alpha, out=alpha_p_sq)
+    numpy.multiply(p, 2.0, out=ratio)
+    numpy.add(ratio, kd, out=ratio)
+    numpy.multiply(ratio, kd, out=ratio)
+    numpy.add(ratio, alpha_p_sq, out=ratio)
+    numpy.divide(l_total, ratio, out=ratio)
+
+    out[0] = p
+    numpy.multiply(p, ratio, out=out[1])
+    numpy.multiply(out[1], 2.0 * numpy.asarray(kd), out=out[1])
+    numpy.multiply(alpha_p_sq, ratio, out=out[2])
+    numpy.multiply(ratio, numpy.asarray(kd) * kd, out=out[3])
+    return out
+
+
+@telemetry.timed('get_plp_derivatives')
+def get_plp_derivatives(kd, alpha, p_total, l_total, p):
+    '''
+    Returns the exact partial derivatives of [PLP] with respect to Kd, alpha,
+    p_total and l_total, in that order. [P]-free is an implicit function of
+    the parameters through the cubic P^3 + aP^2 + bP + c = 0, so its
+    derivatives follow from implicit differentiation: dP/dx = -(dF/dx)/(dF/dP)
+    '''
     a, b, c = calc_abc(kd, alpha, p_total, l_total)
-    q, r = calc_qr(a, b, c)
-    p = []
-    for a_val, q_val, r_val in zip(a, q, r):
-        if numpy.power(q_val, 3.0) + numpy.power(r_val, 2.0) > 0:
-            p.append(cartesian_cubic(a_val, q_val, r_val))
-        else:
-            p.append(polar_cubic(a_val, q_val, r_val))
-    p = numpy.array(p)
-    pl = get_pl(kd, alpha, l_total, p)
-    plp = get_plp(kd, alpha, l_total, p)
-    print(p)
-    return p, pl, plp
+    #The derivative of the cubic with respect to [P]-free
+    df_dp = 3.0 * numpy.power(p, 2.0) + 2.0 * a * p + b
+    p_sq = numpy.power(p, 2.0)
+    #Derivatives of the cubic with respect to each of the parameters, through
+    #the partial derivatives of a, b, and c
+    df_dkd = (2.0 * p_sq + (2.0 * kd + 2.0 * l_total - 2.0 * p_total) * p - 2.0 * kd * p_total) / alpha
+    df_dalpha = -1.0 * (2.0 * kd * p_sq / alpha + b * p + c) / alpha
+    df_dp_total = -1.0 * p_sq - 2.0 * kd * p / alpha - numpy.power(kd, 2.0) / alpha
+    df_dl_total = 2.0 * p_sq + 2.0 * kd * p / alpha
+    dp = [-1.0 * df / df_dp for df in (df_dkd, df_dalpha, df_dp_total, df_dl_total)]
+
+    #[PLP] = alpha * l_total * P^2 / D with D = Kd^2 + 2 Kd P + alpha P^2
+    denominator = numpy.power(kd, 2.0) + 2.0 * kd * p + alpha * p_sq
+    plp = alpha * l_total * p_sq / denominator
+    dplp_dp = 2.0 * alpha * l_total * kd * p * (kd + p) / numpy.power(denominator, 2.0)
+    #The explicit dependence of [PLP] on each of the parameters
+    explicit = [-1.0 * plp * (2.0 * kd + 2.0 * p) / denominator,
+                l_total * p_sq * kd * (kd + 2.0 * p) / numpy.power(denominator, 2.0),
+                0.0,
+                alpha * p_sq / denominator]
+    return tuple(e + dplp_dp * d for e, d in zip(explicit, dp))
+
+
+_model_cache = collections.OrderedDict()
+_model_cache_stats = {'hits': 0, 'misses': 0}
+_workspaces = collections.OrderedDict()
+
+
+def workspace(name, shape, dtype=numpy.float64):
+    '''
+    Returns a scratch array of the given shape and dtype that persists
+    between calls, such as the out and work buffers of get_species within an
+    optimizer loop. Its contents are overwritten by the next caller of the
+    same name, so it must never be returned to or kept by a caller.
+    '''
+    key = (name, tuple(shape), numpy.dtype(dtype).str)
+    buffer = _workspaces.pop(key, None)
+    if buffer is None:
+        buffer = numpy.empty(shape, dtype)
+    _workspaces[key] = buffer
+    while len(_workspaces) > WORKSPACE_SIZE:
+        _workspaces.popitem(last=False)
+    return buffer
+
+
+def solve_species(kd, alpha, p_total, l_total, tolerance=None, scratch=None):
+    '''
+    Returns the species of get_species (4, ...) at broadcastable parameters:
+    by the compiled kernel where it is available and use_compiled is set,
+    and otherwise by free_protein and get_species with the intermediates in
+    a workspace. The bulk evaluations (surfaces, grids, candidate starts and
+    stacked fits) call it directly, the fits through model_species.
+
+    Given a scratch name, the species too are written into the workspace of
+    that name, for loops that use them at once and keep none of them, so
+    that each evaluation allocates neither the species nor the intermediates.
+    '''
+    if tolerance is None:
+        tolerance = precision_tolerance
+    shape = numpy.broadcast(kd, alpha, p_total, l_total).shape
+    dtype = numpy.result_type(kd, alpha, p_total, l_total, 1.0)
+    out = None if scratch is None else workspace(scratch, (len(SPECIES),) + shape, dtype)
+    if use_compiled:
+        from compiled_kernel import compiled_species
+        species = compiled_species(kd, alpha, p_total, l_total, tolerance, out=out)
+        if species is not None:
+            return species
+    p = free_protein(kd, alpha, p_total, l_total, tolerance=tolerance)
+    work = workspace('solve_species' if scratch is None else scratch + '_work', (2,) + shape, dtype)
+    return get_species(kd, alpha, l_total, p, out=out, work=work)
+
+
+def model_cache_key(kd, alpha, p_total, l_total):
+    '''
+    Returns the key of a model evaluation in the cache: the scalar
+    parameters, a digest of the l_total array and the precision settings. Only
+    scalar parameters and numeric arrays are cached, otherwise None.
+    '''
+    if any(numpy.ndim(i) for i in (kd, alpha, p_total)):
+        return None
+    l_total = numpy.ascontiguousarray(l_total)
+    if l_total.dtype.kind != 'f':
+        return None
+    digest = hashlib.sha1(l_total.tobytes()).hexdigest()
+    return (float(kd), float(alpha), float(p_total), l_total.dtype.str, l_total.shape, digest,
+            precision_mode, precision_dps, precision_tolerance)
+
+
+def model_species(kd, alpha, p_total, l_total):
+    '''
+    Returns [P]-free, [PL] and [PLP], remembering the most recent
+    evaluations so that repeating one (as the optimizer, its Jacobian and the
+    plotting do) costs only a lookup. The returned arrays are shared with the
+    cache and so are read-only. Float64 evaluations use the compiled kernel
+    where it is available and use_compiled is set.
+    '''
+    if telemetry.enabled:
+        telemetry.count('model_evaluations')
+    #With the cache off, not even the digest of l_total is computed
+    key = model_cache_key(kd, alpha, p_total, l_total) if MODEL_CACHE_SIZE > 0 else None
+    if key is not None and key in _model_cache:
+        _model_cache_stats['hits'] += 1
+        species = _model_cache.pop(key)
+        _model_cache[key] = species
+        return species
+    #The species are returned (and maybe cached) so need an array of their
+    #own, not a scratch one
+    species = solve_species(kd, alpha, p_total, l_total)
+    if key is None:
+        return tuple(species[:3])
+    _model_cache_stats['misses'] += 1
+    species.setflags(write=False)
+    species = tuple(species[:3])
+    _model_cache[key] = species
+    while len(_model_cache) > MODEL_CACHE_SIZE:
+        _model_cache.popitem(last=False)
+    return species
+
+
+def model_cache_info():
+    '''
+    Returns the hits, misses and current size of the model cache.
+    '''
+    return dict(_model_cache_stats, size=len(_model_cache), maxsize=MODEL_CACHE_SIZE)
+
+
+def clear_model_cache():
+    _model_cache.clear()
+    _model_cache_stats.update(hits=0, misses=0)
+
+
+def model_func(kd, alpha, p_total, l_total):
+    return model_species(kd, alpha, p_total, l_total)
 
 
 def model_fitting(l_total, kd, alpha, p_total):
-    a, b, c = calc_abc(kd, alpha, p_total, l_total)
-    q, r = calc_qr(a, b, c)
-    p = []
-    for a_val, q_val, r_val in zip(a, q, r):
-        if numpy.power(q_val, 3.0) + numpy.power(r_val, 2.0) > 0:
-            p.append(cartesian_cubic(a_val, q_val, r_val))
-        else:
-            p.append(polar_cubic(a_val, q_val, r_val))
-    p = numpy.array(p)
-    plp = get_plp(kd, alpha, l_total, p)
+    p, pl, plp = model_species(kd, alpha, p_total, l_total)
     return numpy.nan_to_num(plp)
 
-def fit():
+def jacobian_fitting(l_total, kd, alpha, p_total):
+    '''
+    The Jacobian of model_fitting, returned as columns of d[PLP]/dKd,
+    d[PLP]/dalpha and d[PLP]/dp_total for each value of l_total.
+    '''
+    p, pl, plp = model_species(kd, alpha, p_total, l_total)
+    d_kd, d_alpha, d_p_total, d_l_total = get_plp_derivatives(kd, alpha, p_total, l_total, p)
+    jac = numpy.column_stack(numpy.broadcast_arrays(d_kd, d_alpha, d_p_total))
+    return numpy.nan_to_num(jac)
+
+def fit_lsq(total_ligand, y_obs, p_total, p0=None):
+    '''
+    Fits Kd, alpha and a scaling factor to the normalized Y-observed by least
+    squares, returning the optimal parameters and their covariance. Unless
+    given, the starting values are estimated from the shape of the data.
+    '''
+    if p0 is None:
+        from start_values import estimate_start
+        p0 = estimate_start(total_ligand, y_obs, p_total)
+
+    #The normalized data is matched through a scaling factor
+    def func(l_total, kd, alpha, scaling):
+        return scaling * model_fitting(l_total, kd, alpha, p_total)
+
+    #The analytic Jacobian spares curve_fit from finite-differencing
+    def jac(l_total, kd, alpha, scaling):
+        d_kd, d_alpha, d_p_total = jacobian_fitting(l_total, kd, alpha, p_total).T
+        return numpy.column_stack((scaling * d_kd, scaling * d_alpha,
+                                   model_fitting(l_total, kd, alpha, p_total)))
+
+    from scipy.optimize import curve_fit
+    if not telemetry.enabled:
+        return curve_fit(func, total_ligand, y_obs, p0=p0, jac=jac)
+    try:
+        popt, pcov, info, message, status = curve_fit(func, total_ligand, y_obs, p0=p0, jac=jac,
+                                                      full_output=True)
+    except RuntimeError as error:
+        telemetry.record('optimizer', {'method': 'lm', 'converged': False, 'message': str(error)})
+        raise
+    #MINPACK evaluates the Jacobian once per iteration
+    telemetry.record('optimizer', {'method': 'lm', 'converged': True, 'status': int(status),
+                                   'message': message, 'iterations': int(info['njev']),
+                                   'function_evaluations': int(info['nfev'])})
+    return popt, pcov
+
+
+def fit_odr(total_ligand, y_obs, y_err, p_total, p0=None, x_err=None):
+    '''
+    Fits Kd, alpha and a scaling factor to the normalized Y-observed by
+    orthogonal distance regression, allowing for error in the total ligand as
+    well as the Y-observed. Points are weighted by the Y-error (zero errors are
+    replaced with the smallest non-zero one) and by x_err which, as in
+    ODRPACK, defaults to unit weights. Returns the optimal parameters and
+    their covariance.
+
+    The problem is solved as a least squares problem in the parameters and
+    the per-point corrections to the total ligand. The derivatives with
+    respect to both are analytic and the Jacobian is sparse, with a diagonal
+    block for the corrections, so the cost grows linearly with the points.
+    '''
+    from scipy.optimize import least_squares
+    from scipy.sparse import bmat, csr_matrix, diags
+
+    if p0 is None:
+        from start_values import estimate_start
+        p0 = estimate_start(total_ligand, y_obs, p_total)
+    n_points = len(total_ligand)
+    positive = y_err[y_err > 0]
+    y_sigma = numpy.where(y_err > 0, y_err, positive.min() if positive.size else 1.0)
+    x_sigma = numpy.ones(n_points) if x_err is None else numpy.asarray(x_err, numpy.float64)
+
+    #The parameters are solved in log-space to keep them positive, followed
+    #by the corrections to each total ligand concentration
+    def split(z):
+        return numpy.exp(z[:3]), z[3:]
+
+    def residuals(z):
+        (kd, alpha, scaling), delta = split(z)
+        model = scaling * model_fitting(total_ligand + delta, kd, alpha, p_total)
+        return numpy.concatenate(((model - y_obs) / y_sigma, delta / x_sigma))
+
+    def derivatives(z):
+        (kd, alpha, scaling), delta = split(z)
+        l_total = total_ligand + delta
+        p = free_protein(kd, alpha, p_total, l_total)
+        plp = get_plp(kd, alpha, l_total, p)
+        d_kd, d_alpha, d_p_total, d_l_total = get_plp_derivatives(kd, alpha, p_total, l_total, p)
+        d_beta = numpy.column_stack((scaling * kd * d_kd, scaling * alpha * d_alpha, scaling * plp))
+        d_beta = numpy.nan_to_num(d_beta) / y_sigma[:, numpy.newaxis]
+        d_delta = numpy.nan_to_num(scaling * d_l_total) / y_sigma
+        return d_beta, d_delta
+
+    def jac(z):
+        d_beta, d_delta = derivatives(z)
+        return bmat([[csr_matrix(d_beta), diags(d_delta)],
+                     [None, diags(1.0 / x_sigma)]], format='csr')
+
+    z0 = numpy.concatenate((numpy.log(p0), numpy.zeros(n_points)))
+    result = least_squares(residuals, z0, jac=jac, method='trf', tr_solver='lsmr', x_scale='jac')
+    beta = numpy.exp(result.x[:3])
+    if telemetry.enabled:
+        telemetry.record('optimizer', {'method': 'trf', 'converged': bool(result.success),
+                                       'status': int(result.status), 'message': result.message,
+                                       'iterations': int(result.njev),
+                                       'function_evaluations': int(result.nfev)})
+
+    #Covariance of the parameters from the Schur complement of the diagonal
+    #block of the corrections, scaled by the residual variance as ODRPACK does
+    d_beta, d_delta = derivatives(result.x)
+    d_diag = numpy.power(d_delta, 2.0) + numpy.power(1.0 / x_sigma, 2.0)
+    coupling = d_beta * d_delta[:, numpy.newaxis]
+    reduced = d_beta.T.dot(d_beta) - coupling.T.dot(coupling / d_diag[:, numpy.newaxis])
+    res_var = 2.0 * result.cost / max(n_points - 3, 1)
+    pcov = numpy.linalg.pinv(reduced) * res_var * numpy.outer(beta, beta)
+    return beta, pcov
+
+
+def load_fit_data(file_path):
+    '''
+    Reads an input file for fitting, returning the total ligand, the
+    normalized Y-observed and Y-error, the protein concentration and the
+    guesses of Kd and alpha from its header (None if it has none).
+    '''
+    from start_values import header_guess
+
     #Read in the information from the input file
-    parameters, data = parse_input_file(arguments['<input>'])
+    parameters, data = parse_input_file(file_path)
     #Unpack the data list into the components
     total_ligand, y_obs, y_err, weight = data
-    print(total_ligand.dtype)
 
     #Unless working with units of concentration in the Y-observed (not my
     #present use-case) the Y-observed must be scaled and normalized in a way
     #that allows the model's predicted Y values to be relevant. This
     #consequently adds another dimension for fitting.
 
-    #Let's pick some hypothetical values for an M8 experiment, units are in uM
-    #kd = 2.5
-    #alpha = 1000
-    #p_total = 0.1
+    p_total = header_p_total(parameters)
+    y_err = y_err / y_obs.max()
+    y_obs = y_obs / y_obs.max()
+    return total_ligand, y_obs, y_err, p_total, header_guess(parameters)
+
+
+def header_p_total(parameters):
+    '''
+    The protein concentration from the header of an input file, or for
+    headers without one the hypothetical value used before (for an M8
+    experiment, in uM).
+    '''
+    return float(parameters.get('prot_total', DEFAULT_P_TOTAL))
+
+
+def write_telemetry(file_path, seconds):
+    '''
+    Writes the instrumentation report of a fit, with its model cache
+    statistics and the total time, as JSON.
+    '''
+    report = telemetry.report()
+    report['model_cache'] = model_cache_info()
+    report['seconds'] = seconds
+    with open(file_path, 'w') as output:
+        json.dump(report, output, indent=2, sort_keys=True)
+        output.write('\n')
+
 
+def fit():
+    if arguments['--telemetry']:
+        telemetry.enable()
+    start = time.time()
+    total_ligand, y_obs, y_err, p_total, guess = load_fit_data(arguments['<input>'])
+    print(total_ligand.dtype)
+    from start_values import estimate_start
+    p0 = estimate_start(total_ligand, y_obs, p_total, guess)
     if arguments['--lsq']:
         #First argument must be the independent argument, the others will be
         #fitted
-        #p_total = 0.1
-        y_obs = y_obs / y_obs.max()
-        popt, pcov = curve_fit(lambda total_ligand, kd, alpha: model_fitting(total_ligand, kd, alpha, 0.1), total_ligand, y_obs, p0=(800, 100))
+        if arguments['--approximate']:
+            from solution_table import fit_approximate
+            popt, pcov = fit_approximate(total_ligand, y_obs, p_total, p0=p0)
+        else:
+            popt, pcov = fit_lsq(total_ligand, y_obs, p_total, p0=p0)
         print(popt)
+    elif arguments['--odr']:
+        popt, pcov = fit_odr(total_ligand, y_obs, y_err, p_total, p0=p0)
+        print(popt)
+    if arguments['--bootstrap']:
+        report_bootstrap(total_ligand, y_obs, y_err, p_total, popt)
+    if arguments['--telemetry']:
+        telemetry.disable()
+        write_telemetry(arguments['--telemetry'], time.time() - start)
 
+    if arguments['--no-plot']:
+        return
+    import matplotlib
+    if arguments['--plot-to']:
+        #Render off-screen, which needs no display
+        matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
     plt.plot(total_ligand, y_obs, 'x', label='rawdata')
     newx = numpy.logspace(0,5.1)
-    plt.plot(newx, model_fitting(newx, popt[0], popt[1], 0.1), label='fit')
+    plt.plot(newx, popt[2] * model_fitting(newx, popt[0], popt[1], p_total), label='fit')
     plt.legend(loc='center right')
     plt.xscale('log')
     plt.grid()
-    plt.show()
+    if arguments['--plot-to']:
+        plt.savefig(arguments['--plot-to'])
+    else:
+        plt.show()
 
     #kd = .02
     #alpha = .05
@@ -213,11 +948,274 @@ def fit():
     #plt.show()
 
 
+def parse_range(text):
+    '''
+    Parses a grid given as first,last,count into its values.
+    '''
+    first, last, count = text.split(',')
+    return numpy.linspace(float(first), float(last), int(count))
+
+
+def surface():
+    '''
+    Evaluates the chi-square surface of an input file over the --kd-range
+    and --alpha-range grid, and writes it to the output file (by default the
+    input file name with .surface.npz appended) for plotting.
+    '''
+    from chi_surface import chi_square_surface, write_surface
+
+    total_ligand, y_obs, y_err, p_total, guess = load_fit_data(arguments['<input>'])
+    log_kd = parse_range(arguments['--kd-range'])
+    log_alpha = parse_range(arguments['--alpha-range'])
+    scaling = float(arguments['--scaling']) if arguments['--scaling'] else None
+    chi_square, scalings = chi_square_surface(total_ligand, y_obs, p_total, log_kd, log_alpha,
+                                              y_err=y_err, scaling=scaling)
+    output = arguments['<output>'] or arguments['<input>'] + '.surface.npz'
+    write_surface(output, log_kd, log_alpha, chi_square, scalings)
+    best = numpy.unravel_index(numpy.argmin(chi_square), chi_square.shape)
+    print('minimum chi-square {0:.6g} at Kd {1:.6g}, alpha {2:.6g}, scaling {3:.6g}'.format(
+        chi_square[best], 10.0 ** log_kd[best[0]], 10.0 ** log_alpha[best[1]], scalings[best]))
+
+
+BATCH_PARAMETERS = ('kd', 'alpha', 'scaling')
+
+
+def process_count():
+    '''
+    Returns the number of worker processes given by --processes.
+    '''
+    if arguments['--processes'] in (None, 'all cores'):
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    return int(arguments['--processes'])
+
+
+def report_bootstrap(total_ligand, y_obs, y_err, p_total, popt):
+    '''
+    Refits --bootstrap replicates of the data about the best fit and prints
+    the 95% percentile interval of each parameter.
+    '''
+    from bootstrap import RESAMPLE_SOURCES, bootstrap, percentile_intervals
+
+    source = arguments['--resample']
+    if source not in RESAMPLE_SOURCES:
+        raise ValueError('--resample must be one of: {0}'.format(', '.join(RESAMPLE_SOURCES)))
+    n_replicates = int(arguments['--bootstrap'])
+    params, converged = bootstrap(total_ligand, y_obs, p_total, popt, n_replicates,
+                                  y_err=y_err if source == 'errors' else None,
+                                  processes=process_count())
+    intervals = percentile_intervals(params, converged)
+    print('bootstrap: {0} of {1} replicates converged'.format(converged.sum(), n_replicates))
+    for name, value, (lower, upper) in zip(BATCH_PARAMETERS, popt, intervals):
+        print('{0}\t{1:.6g}\t95% interval {2:.6g} to {3:.6g}'.format(name, value, lower, upper))
+
+
+def expand_inputs(patterns):
+    '''
+    Expands the batch inputs into a sorted list of file paths. Each input may
+    be a file, a directory (all files within it are used) or a glob pattern.
+    The binary sidecars written beside the inputs are never inputs themselves.
+    '''
+    file_paths = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            matches = [os.path.join(pattern, i) for i in os.listdir(pattern)]
+        else:
+            matches = glob.glob(pattern) or [pattern]
+        file_paths.extend(i for i in matches if not os.path.isdir(i) and not i.endswith(SIDECAR_SUFFIX))
+    return sorted(set(file_paths))
+
+
+def fit_file(file_path):
+    '''
+    Fits a single input file for the batch, returning a row of the results
+    table. Any failure is recorded in the row rather than raised so that one
+    bad file does not abort the batch.
+    '''
+    start = time.time()
+    row = {'file': file_path, 'status': 'ok', 'error': ''}
+    try:
+        from start_values import estimate_start
+        total_ligand, y_obs, y_err, p_total, guess = load_fit_data(file_path)
+        popt, pcov = fit_lsq(total_ligand, y_obs, p_total, p0=estimate_start(total_ligand, y_obs, p_total, guess))
+        residuals = popt[2] * model_fitting(total_ligand, popt[0], popt[1], p_total) - y_obs
+        row['residual_norm'] = numpy.linalg.norm(residuals)
+        for i, name in enumerate(BATCH_PARAMETERS):
+            row[name] = popt[i]
+            for j, other in enumerate(BATCH_PARAMETERS[i:], i):
+                row['cov_{0}_{1}'.format(name, other)] = pcov[i, j]
+    except Exception as error:
+        row['status'] = 'failed'
+        #Keep the message on a single line of the table
+        row['error'] = ' '.join('{0}: {1}'.format(type(error).__name__, error).split())
+    row['seconds'] = time.time() - start
+    return row
+
+
+def fit_files_stacked(file_paths):
+    '''
+    Fits every input file at once with the stacked Levenberg-Marquardt
+    solver, returning the rows of the results table as fit_file does. The
+    time of the stacked fit is shared out evenly among the files.
+    '''
+    from stacked_lm import fit_stacked
+    from start_values import estimate_start
+
+    rows, datasets = [], []
+    for file_path in file_paths:
+        row = {'file': file_path, 'status': 'ok', 'error': ''}
+        try:
+            total_ligand, y_obs, y_err, p_total, guess = load_fit_data(file_path)
+            datasets.append((row, total_ligand, y_obs, p_total, guess))
+        except Exception as error:
+            row['status'] = 'failed'
+            row['error'] = ' '.join('{0}: {1}'.format(type(error).__name__, error).split())
+        rows.append(row)
+    if not datasets:
+        return rows
+
+    start = time.time()
+    fitted_rows, total_ligand, y_obs, p_total, guesses = zip(*datasets)
+    p0 = [estimate_start(*i) for i in zip(total_ligand, y_obs, p_total, guesses)]
+    popt, pcov, cost, converged = fit_stacked(total_ligand, y_obs, p_total, p0=p0)
+    seconds = (time.time() - start) / len(datasets)
+    for row, params, cov, residual, success in zip(fitted_rows, popt, pcov, cost, converged):
+        row['residual_norm'] = numpy.sqrt(residual)
+        row['seconds'] = seconds
+        for i, name in enumerate(BATCH_PARAMETERS):
+            row[name] = params[i]
+            for j, other in enumerate(BATCH_PARAMETERS[i:], i):
+                row['cov_{0}_{1}'.format(name, other)] = cov[i, j]
+        if not success:
+            row['status'] = 'failed'
+            row['error'] = 'Optimal parameters not found: iteration limit reached'
+    return rows
+
+
+def batch_columns():
+    columns = ['file', 'status'] + list(BATCH_PARAMETERS)
+    for i, name in enumerate(BATCH_PARAMETERS):
+        columns.extend('cov_{0}_{1}'.format(name, other) for other in BATCH_PARAMETERS[i:])
+    return columns + ['residual_norm', 'seconds', 'error']
+
+
+def write_table(rows, columns):
+    '''
+    Writes rows of results as a tab-separated table to the --output file, or
+    to standard output.
+    '''
+    lines = ['\t'.join(columns)]
+    for row in rows:
+        lines.append('\t'.join(str(row.get(i, '')) for i in columns))
+    if arguments['--output']:
+        with open(arguments['--output'], 'w') as out:
+            out.write('\n'.join(lines) + '\n')
+    else:
+        print('\n'.join(lines))
+
+
+def batch():
+    '''
+    Fits every input file in parallel across a process pool (or all together
+    with the stacked solver), never plotting, and writes a single
+    tab-separated table of the results.
+    '''
+    file_paths = expand_inputs(arguments['<inputs>'])
+    if arguments['--stacked']:
+        rows = fit_files_stacked(file_paths)
+    else:
+        import multiprocessing
+        pool = multiprocessing.Pool(process_count())
+        try:
+            rows = pool.map(fit_file, file_paths, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+    write_table(rows, batch_columns())
+    failed = sum(row['status'] != 'ok' for row in rows)
+    if failed:
+        sys.stderr.write('{0} of {1} files failed to fit\n'.format(failed, len(rows)))
+
+
+def global_fit():
+    '''
+    Fits a linked set of input files as one problem, with the --shared
+    parameters common to every series and the others local to each. Every
+    series uses the protein concentration from its own header, and all of the
+    Y-observed are normalized by the same (overall) maximum so that a shared
+    scaling remains meaningful.
+    '''
+    from global_fit import fit_global
+
+    file_paths = expand_inputs(arguments['<inputs>'])
+    shared = [i.strip() for i in arguments['--shared'].split(',') if i.strip()]
+    series = parse_input_files(file_paths)
+    y_max = max(data[1].max() for parameters, data in series)
+    datasets = [(data[0], data[1] / y_max, header_p_total(parameters)) for parameters, data in series]
+    popt, pcov, cost = fit_global(datasets, shared=shared)
+
+    rows = []
+    for file_path, dataset, params, cov, residual in zip(file_paths, datasets, popt, pcov, cost):
+        row = {'file': file_path, 'p_total': dataset[2], 'residual_norm': numpy.sqrt(residual)}
+        for i, name in enumerate(BATCH_PARAMETERS):
+            row[name] = params[i]
+            for j, other in enumerate(BATCH_PARAMETERS[i:], i):
+                row['cov_{0}_{1}'.format(name, other)] = cov[i, j]
+        rows.append(row)
+    columns = ['file', 'p_total'] + batch_columns()[2:-2]
+    write_table(rows, columns)
+
+
+def multistart_fit():
+    '''
+    Fits an input file from many starts across log Kd and log alpha, the
+    first estimated from the data, and writes a table of every distinct
+    minimum found from the lowest cost up.
+    '''
+    from multistart import multistart
+    from start_values import estimate_start
+
+    total_ligand, y_obs, y_err, p_total, guess = load_fit_data(arguments['<input>'])
+    minima, fitted, failed = multistart(total_ligand, y_obs, p_total, parse_range(arguments['--kd-box']),
+                                        parse_range(arguments['--alpha-box']),
+                                        n_starts=int(arguments['--starts']),
+                                        consensus=int(arguments['--consensus']), processes=process_count(),
+                                        first_start=estimate_start(total_ligand, y_obs, p_total, guess),
+                                        seed=int(arguments['--seed']) if arguments['--seed'] else None)
+    rows = []
+    for minimum in minima:
+        row = dict(zip(BATCH_PARAMETERS, minimum['params']))
+        row.update(cost=minimum['cost'], hits=minimum['hits'])
+        rows.append(row)
+    write_table(rows, list(BATCH_PARAMETERS) + ['cost', 'hits'])
+    sys.stderr.write('{0} distinct minima from {1} starts ({2} failed)\n'.format(len(minima), fitted, failed))
+
+
 if __name__ == '__main__':
+    #The helper modules import this script as ligfit, which should share its
+    #settings (such as precision_dps) rather than load a second copy
+    sys.modules.setdefault('ligfit', sys.modules[__name__])
     arguments = docopt(__doc__, version='0.0.1')
     if arguments['--precision']:
-        mp.dps = int(arguments['--precision'])
+        precision_dps = int(arguments['--precision'])
+    precision_tolerance = float(arguments['--tolerance'])
+    precision_mode = arguments['--precision-mode']
+    if precision_mode not in PRECISION_MODES:
+        raise ValueError('--precision-mode must be one of: {0}'.format(', '.join(PRECISION_MODES)))
     if arguments['makeinput']:
         make_input_file()
     elif arguments['fit']:
         fit()
+    elif arguments['surface']:
+        surface()
+    elif arguments['batch']:
+        batch()
+    elif arguments['global']:
+        global_fit()
+    elif arguments['multistart']:
+        multistart_fit()
+    elif arguments['serve']:
+        from fit_service import serve
+        serve(host=arguments['--host'], port=int(arguments['--port']), socket_path=arguments['--socket'],
+              processes=process_count(), queue_size=int(arguments['--queue']) if arguments['--queue'] else None)
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Multi-start search for the Kd and alpha of a dataset. At high alpha the
+[PLP] curves barely change over orders of magnitude (see
+resources/shifts_at_high_alpha.py), so the cost is flat and ridge-shaped and
+a single local fit may well stop in the wrong basin.
+
+Starts are drawn one at a time from each box of a grid over log Kd and log
+alpha, the boxes taken in random order (and afresh once each has had a
+start), with the scaling factor at its closed-form optimum. The local fits
+run concurrently across a process pool, and each converged fit is merged
+with any earlier minimum it matches to within MERGE_DECADES in every
+parameter. The search stops once the start budget is spent or enough fits
+agree on the lowest cost, whether at one minimum or along a ridge of them.
+"""
+
+import numpy
+
+from ligfit import fit_lsq, model_fitting, solve_species
+
+#Fits whose parameters all agree to within this many decades are taken to
+#have found the same minimum
+MERGE_DECADES = 0.01
+
+#Fits within this relative cost of the lowest agree on it, even when they
+#stop at different points along a flat ridge
+CONSENSUS_COST = 1e-6
+
+_data = None
+
+
+def sample_starts(log_kd_edges, log_alpha_edges, n_starts, seed=None):
+    '''
+    Yields n_starts pairs of log10 Kd and log10 alpha, each drawn uniformly
+    within a box between consecutive edges. Every box has a start before any
+    has a second.
+    '''
+    random = numpy.random.RandomState(seed)
+    n_kd, n_alpha = len(log_kd_edges) - 1, len(log_alpha_edges) - 1
+    drawn = 0
+    while drawn < n_starts:
+        for box in random.permutation(n_kd * n_alpha)[:n_starts - drawn]:
+            i, j = divmod(box, n_alpha)
+            yield (random.uniform(log_kd_edges[i], log_kd_edges[i + 1]),
+                   random.uniform(log_alpha_edges[j], log_alpha_edges[j + 1]))
+            drawn += 1
+
+
+def optimal_scaling(total_ligand, y_obs, p_total, kd, alpha):
+    '''
+    The scaling factor minimizing the residual of the Y-observed at Kd and
+    alpha, in closed form as the model is linear in it.
+    '''
+    model = numpy.nan_to_num(solve_species(kd, alpha, p_total, total_ligand)[2])
+    return numpy.sum(model * y_obs) / max(numpy.sum(model * model), 1e-300)
+
+
+def init_worker(total_ligand, y_obs, p_total):
+    '''
+    Holds the dataset once in each worker process.
+    '''
+    global _data
+    _data = (total_ligand, y_obs, p_total)
+
+
+def fit_start(start):
+    '''
+    Fits the dataset by least squares from a start of Kd, alpha and scaling.
+    Returns the start, the fitted parameters and their cost (the sum of
+    squared residuals), with None for the parameters of a fit that failed or
+    left the positive parameters.
+    '''
+    total_ligand, y_obs, p_total = _data
+    try:
+        with numpy.errstate(all='ignore'):
+            popt = fit_lsq(total_ligand, y_obs, p_total, p0=start)[0]
+            residuals = popt[2] * model_fitting(total_ligand, popt[0], popt[1], p_total) - y_obs
+    except (RuntimeError, ValueError, numpy.linalg.LinAlgError):
+        return start, None, numpy.inf
+    cost = residuals.dot(residuals)
+    if not (numpy.all(popt > 0) and numpy.isfinite(cost)):
+        return start, None, numpy.inf
+    return start, popt, cost
+
+
+def merge_minimum(minima, popt, cost):
+    '''
+    Adds a fitted minimum to the list, or counts another hit of the earlier
+    minimum that it matches, keeping whichever of the two has the lower cost.
+    Returns the minimum it was merged into.
+    '''
+    log_popt = numpy.log10(popt)
+    for minimum in minima:
+        if numpy.all(numpy.abs(numpy.log10(minimum['params']) - log_popt) <= MERGE_DECADES):
+            minimum['hits'] += 1
+            if cost < minimum['cost']:
+                minimum['params'], minimum['cost'] = popt, cost
+            return minimum
+    minima.append({'params': popt, 'cost': cost, 'hits': 1})
+    return minima[-1]
+
+
+def fitted_starts(starts, processes=1):
+    '''
+    Yields the result of fit_start for each start as the fits finish,
+    concurrently across the given number of processes. Stopping the
+    iteration terminates the fits still running.
+    '''
+    if processes == 1:
+        for start in starts:
+            yield fit_start(start)
+        return
+    import multiprocessing
+    pool = multiprocessing.Pool(processes, initializer=init_worker, initargs=_data)
+    try:
+        for result in pool.imap_unordered(fit_start, starts, chunksize=1):
+            yield result
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def multistart(total_ligand, y_obs, p_total, log_kd_edges, log_alpha_edges, n_starts=80,
+               consensus=5, processes=1, first_start=None, seed=None):
+    '''
+    Searches for the minima of the least squares cost of a dataset from up to
+    n_starts starts across the boxes of the log10 Kd and log10 alpha edges,
+    beginning with first_start (such as from estimate_start) if given. The
+    search stops early once consensus fits have converged to within
+    CONSENSUS_COST of the lowest cost found.
+
+    Returns every distinct minimum, as dicts of the parameters (Kd, alpha,
+    scaling), their cost and the number of starts that reached it, from the
+    lowest cost up, and the number of starts fitted and of those that failed.
+    '''
+    init_worker(total_ligand, y_obs, p_total)
+
+    def starts():
+        if first_start is not None:
+            yield tuple(first_start)
+        for log_kd, log_alpha in sample_starts(log_kd_edges, log_alpha_edges,
+                                               n_starts - (first_start is not None), seed=seed):
+            kd, alpha = 10.0 ** log_kd, 10.0 ** log_alpha
+            with numpy.errstate(all='ignore'):
+                yield kd, alpha, optimal_scaling(total_ligand, y_obs, p_total, kd, alpha)
+
+    minima = []
+    fitted, failed = 0, 0
+    processes = max(1, min(processes, n_starts))
+    for start, popt, cost in fitted_starts(starts(), processes=processes):
+        fitted += 1
+        if popt is None:
+            failed += 1
+            continue
+        merge_minimum(minima, popt, cost)
+        lowest = min(i['cost'] for i in minima)
+        if sum(i['hits'] for i in minima if i['cost'] <= lowest * (1.0 + CONSENSUS_COST)) >= consensus:
+            break
+    return sorted(minima, key=lambda i: i['cost']), fitted, failed
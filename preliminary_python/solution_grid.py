@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""LigFit solution grid
+
+Generates [PLP] over a grid of log L_total, log alpha and log P_total (at a
+fixed Kd) too large to hold in memory, as for lookup tables and figures of
+the solution space. The grid is evaluated in cache-sized chunks across a
+process pool and written straight into a memory-mapped .npy file. Finished
+chunks are recorded alongside it, so that an interrupted run picks up where
+it stopped when started again with the same grid. Plotting is a separate
+step, reading only as much of the grid as the figure shows.
+
+Usage:
+  solution_grid.py generate <grid> [--kd=<kd>] [--l-range=<range>]
+                   [--alpha-range=<range>] [--p-range=<range>]
+                   [--tolerance=<tol>] [--chunk=<points>] [--processes=<n>]
+                   [--dtype=<type>] [--quiet]
+  solution_grid.py plot <grid> [--p-index=<i>] [--plot-to=<file>]
+
+Options:
+  --kd=<kd>              dissociation constant of the grid [default: 1]
+  --l-range=<range>      log10 L_total axis, as first,last,count
+                         [default: -2,3.5,100]
+  --alpha-range=<range>  log10 alpha axis, as first,last,count
+                         [default: -2,8,100]
+  --p-range=<range>      log10 P_total axis, as first,last,count
+                         [default: 0,0,1]
+  --tolerance=<tol>      relative error in [P]-free beyond which a point is
+                         escalated to higher precision [default: 1e-10]
+  --chunk=<points>       number of points evaluated at once [default: 32768]
+  --processes=<n>        number of worker processes [default: all cores]
+  --dtype=<type>         float64 or float32 [default: float64]
+  --quiet                do not report progress
+  --p-index=<i>          index along the P_total axis of the surface to plot
+                         [default: 0]
+  --plot-to=<file>       save the plot to a file (its format given by the
+                         extension) instead of showing it
+  -h --help              show this help message and exit
+
+"""
+
+import json
+import os
+import sys
+
+import numpy
+from numpy.lib.format import open_memmap
+
+import ligfit
+
+#Points evaluated at once; the dozen or so temporaries of the cubic solve of
+#a chunk then fit within the L2 cache
+CHUNK_POINTS = 1 << 15
+
+#Largest number of points along either axis of a plotted surface
+PLOT_POINTS = 200
+
+_grid = None
+
+
+def manifest_path(file_path):
+    return file_path + '.json'
+
+
+def done_path(file_path):
+    return file_path + '.done.npy'
+
+
+def grid_manifest(kd, log_l, log_alpha, log_p, tolerance, chunk_points, dtype):
+    '''
+    Everything that determines the contents of a grid file, as stored beside
+    it. A run only resumes a grid whose manifest matches its own.
+    '''
+    return {'kd': float(kd), 'log_l': [float(i) for i in log_l], 'log_alpha': [float(i) for i in log_alpha],
+            'log_p': [float(i) for i in log_p], 'tolerance': float(tolerance),
+            'precision_mode': ligfit.precision_mode, 'precision_dps': ligfit.precision_dps,
+            'chunk_points': int(chunk_points), 'dtype': numpy.dtype(dtype).name}
+
+
+def load_manifest(file_path):
+    with open(manifest_path(file_path)) as manifest_file:
+        return json.load(manifest_file)
+
+
+def open_grid(file_path, manifest):
+    '''
+    Returns the grid (P_total, alpha, L_total) and the done flag of each
+    chunk as memory maps, creating the files if they do not exist yet.
+    '''
+    shape = (len(manifest['log_p']), len(manifest['log_alpha']), len(manifest['log_l']))
+    n_chunks = -(-int(numpy.prod(shape)) // manifest['chunk_points'])
+    if os.path.exists(file_path):
+        if not os.path.exists(manifest_path(file_path)) or load_manifest(file_path) != manifest:
+            raise ValueError('{0} holds a different grid; remove it or give another file'.format(file_path))
+        return open_memmap(file_path, mode='r+'), open_memmap(done_path(file_path), mode='r+')
+    values = open_memmap(file_path, mode='w+', dtype=manifest['dtype'], shape=shape)
+    done = open_memmap(done_path(file_path), mode='w+', dtype=bool, shape=(n_chunks,))
+    #The manifest is written last, so that its presence means the grid files
+    #are complete
+    with open(manifest_path(file_path), 'w') as manifest_file:
+        json.dump(manifest, manifest_file)
+    return values, done
+
+
+def init_worker(file_path, manifest):
+    '''
+    Opens the grid once in each worker process.
+    '''
+    global _grid
+    values = open_memmap(file_path, mode='r+')
+    _grid = (values, manifest)
+
+
+def evaluate_chunk(chunk):
+    '''
+    Evaluates [PLP] at the points of one chunk of the flattened grid, writes
+    them into the grid file and flushes it. Returns the chunk index.
+    '''
+    values, manifest = _grid
+    kd = manifest['kd']
+    start = chunk * manifest['chunk_points']
+    stop = min(start + manifest['chunk_points'], values.size)
+    i_p, i_alpha, i_l = numpy.unravel_index(numpy.arange(start, stop), values.shape)
+    l_total = numpy.power(10.0, numpy.asarray(manifest['log_l'])[i_l])
+    alpha = numpy.power(10.0, numpy.asarray(manifest['log_alpha'])[i_alpha])
+    p_total = numpy.power(10.0, numpy.asarray(manifest['log_p'])[i_p])
+    values.reshape(-1)[start:stop] = ligfit.solve_species(kd, alpha, p_total, l_total,
+                                                          tolerance=manifest['tolerance'])[2]
+    values.flush()
+    return chunk
+
+
+def evaluate_chunks(file_path, manifest, processes=1):
+    '''
+    Evaluates every chunk of the grid not yet done, yielding the number of
+    chunks done and their total as each one finishes. A chunk is only marked
+    done once its values are flushed to the file.
+    '''
+    values, done = open_grid(file_path, manifest)
+    pending = numpy.flatnonzero(~done).tolist()
+    finished = len(done) - len(pending)
+    del values
+    processes = max(1, min(processes, len(pending)))
+    if processes == 1:
+        init_worker(file_path, manifest)
+        chunks = (evaluate_chunk(i) for i in pending)
+        pool = None
+    else:
+        import multiprocessing
+        pool = multiprocessing.Pool(processes, initializer=init_worker, initargs=(file_path, manifest))
+        chunks = pool.imap_unordered(evaluate_chunk, pending, chunksize=1)
+    try:
+        for chunk in chunks:
+            done[chunk] = True
+            done.flush()
+            finished += 1
+            yield finished, len(done)
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+
+def generate_grid(file_path, kd=1.0, log_l=None, log_alpha=None, log_p=(0.0,), tolerance=None,
+                  chunk_points=CHUNK_POINTS, processes=1, dtype=numpy.float64, quiet=True):
+    '''
+    Fills (or resumes filling) a grid file with [PLP] over the given log10
+    axes, by default those of resources/solution_space.py, and returns the
+    grid as a read-only memory map (P_total, alpha, L_total).
+    '''
+    if log_l is None:
+        log_l = numpy.linspace(-2.0, 3.5, 100)
+    if log_alpha is None:
+        log_alpha = numpy.linspace(-2.0, 8.0, 100)
+    if tolerance is None:
+        tolerance = ligfit.precision_tolerance
+    manifest = grid_manifest(kd, log_l, log_alpha, log_p, tolerance, chunk_points, dtype)
+    for finished, total in evaluate_chunks(file_path, manifest, processes=processes):
+        if not quiet:
+            sys.stderr.write('\r{0} of {1} chunks done'.format(finished, total))
+    if not quiet:
+        sys.stderr.write('\n')
+    return load_grid(file_path)
+
+
+def load_grid(file_path):
+    '''
+    Returns a finished grid as a read-only memory map, with its manifest.
+    '''
+    done = numpy.load(done_path(file_path), mmap_mode='r')
+    if not done.all():
+        raise ValueError('{0} is incomplete ({1} of {2} chunks done); run generate again to resume'.format(
+            file_path, int(done.sum()), len(done)))
+    return numpy.load(file_path, mmap_mode='r'), load_manifest(file_path)
+
+
+def plot_grid(file_path, p_index=0, plot_to=None):
+    '''
+    Plots the surface of [PLP] at one P_total of a grid, as the figure of
+    resources/solution_space.py. Large grids are subsampled to at most
+    PLOT_POINTS along each axis, so only those rows are read from the file.
+    '''
+    import matplotlib
+    if plot_to:
+        matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    from matplotlib import cm
+    from mpl_toolkits.mplot3d import Axes3D
+
+    values, manifest = load_grid(file_path)
+    log_l = numpy.asarray(manifest['log_l'])
+    log_alpha = numpy.asarray(manifest['log_alpha'])
+    l_step = -(-len(log_l) // PLOT_POINTS)
+    alpha_step = -(-len(log_alpha) // PLOT_POINTS)
+    plp_soln = numpy.asarray(values[p_index, ::alpha_step, ::l_step], dtype=numpy.float64)
+    lm, am = numpy.meshgrid(log_l[::l_step], log_alpha[::alpha_step])
+
+    fig = plt.figure()
+    ax = fig.add_subplot(111, projection='3d')
+    surf = ax.plot_surface(lm, am, plp_soln, rstride=1, cstride=1,
+                           cmap=cm.coolwarm, linewidth=0, antialiased=False, alpha=0.6)
+    ax.contour(lm, am, plp_soln, zdir='x', offset=log_l[0], cmap=cm.winter)
+    ax.contour(lm, am, plp_soln, zdir='y', offset=log_alpha[-1], cmap=cm.winter)
+    fig.colorbar(surf, shrink=0.5, aspect=5)
+    ax.set_xlabel('Log-Total Ligand [L] (conc.)')
+    ax.set_ylabel('Log-Cooperativity')
+    ax.set_zlabel('Dimerized Protein [PLP](conc.)')
+    ax.set_title('Kd = {0:g}, P_total = {1:g}'.format(manifest['kd'], 10.0 ** manifest['log_p'][p_index]))
+    if plot_to:
+        plt.savefig(plot_to)
+    else:
+        plt.show()
+
+
+if __name__ == '__main__':
+    from docopt import docopt
+    arguments = docopt(__doc__)
+    if arguments['generate']:
+        if arguments['--dtype'] not in ('float64', 'float32'):
+            raise ValueError('--dtype must be float64 or float32')
+        if arguments['--processes'] == 'all cores':
+            import multiprocessing
+            processes = multiprocessing.cpu_count()
+        else:
+            processes = int(arguments['--processes'])
+        generate_grid(arguments['<grid>'], kd=float(arguments['--kd']),
+                      log_l=ligfit.parse_range(arguments['--l-range']),
+                      log_alpha=ligfit.parse_range(arguments['--alpha-range']),
+                      log_p=ligfit.parse_range(arguments['--p-range']),
+                      tolerance=float(arguments['--tolerance']), chunk_points=int(arguments['--chunk']),
+                      processes=processes, dtype=arguments['--dtype'], quiet=arguments['--quiet'])
+    elif arguments['plot']:
+        plot_grid(arguments['<grid>'], p_index=int(arguments['--p-index']), plot_to=arguments['--plot-to'])
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+A precomputed table of the normalized solution space, [PLP]/P_total, which
+depends only on log(L_total/Kd), log(alpha) and log(P_total/Kd). The table is
+computed once at high precision and shipped alongside ligfit.py; the lookup
+interpolates within it, both to find starting values for fitting and as an
+approximate but fast evaluation of the model (`ligfit.py fit --lsq
+--approximate`).
+
+Run this file to regenerate the table.
+"""
+
+import os
+
+import numpy
+
+import telemetry
+from ligfit import solve_species
+
+TABLE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'solution_space.npz')
+
+#Grid of the table in log10 units
+LOG_L = numpy.linspace(-4.0, 8.0, 97)
+LOG_ALPHA = numpy.linspace(-2.0, 9.0, 45)
+LOG_P = numpy.linspace(-6.0, 2.0, 33)
+
+_table = None
+
+
+def build_table(file_path=TABLE_PATH, tolerance=1e-12):
+    '''
+    Computes [PLP]/P_total over the grid with Kd = 1 and writes the table.
+    The tolerance is passed on to solve_species, so that every point is
+    escalated to as high a precision as it needs.
+    '''
+    l_total = numpy.power(10.0, LOG_L)
+    alpha = numpy.power(10.0, LOG_ALPHA)[:, numpy.newaxis]
+    p_total = numpy.power(10.0, LOG_P)[:, numpy.newaxis, numpy.newaxis]
+    fraction = solve_species(1.0, alpha, p_total, l_total, tolerance=tolerance)[2] / p_total
+    numpy.savez_compressed(file_path, log_l=LOG_L, log_alpha=LOG_ALPHA, log_p=LOG_P,
+                           fraction=fraction.astype(numpy.float32))
+
+
+def load_table(file_path=TABLE_PATH):
+    '''
+    Returns the table as an interpolator over (log P/Kd, log alpha, log L/Kd),
+    loading it from disk on first use.
+    '''
+    global _table
+    if _table is None or file_path != TABLE_PATH:
+        from scipy.interpolate import RegularGridInterpolator
+        with numpy.load(file_path) as data:
+            grid = (data['log_p'], data['log_alpha'], data['log_l'])
+            table = RegularGridInterpolator(grid, data['fraction'].astype(numpy.float64))
+        if file_path != TABLE_PATH:
+            return table
+        _table = table
+    return _table
+
+
+def lookup(l_ratio, alpha, p_ratio):
+    '''
+    Interpolates [PLP]/P_total at the given L_total/Kd, alpha and P_total/Kd,
+    which are broadcast together. Values beyond the table are clamped to its
+    edges.
+    '''
+    table = load_table()
+    points = numpy.broadcast_arrays(numpy.log10(p_ratio), numpy.log10(alpha), numpy.log10(l_ratio))
+    points = [numpy.clip(i, axis[0], axis[-1]) for i, axis in zip(points, table.grid)]
+    return table(numpy.stack(points, axis=-1))
+
+
+def approx_model_fitting(l_total, kd, alpha, p_total):
+    '''
+    A fast approximation of ligfit.model_fitting by interpolation in the
+    table. Inside the tabulated range the error is typically a few parts in a
+    thousand of P_total, and at worst a few percent.
+    '''
+    return p_total * lookup(l_total / kd, alpha, p_total / kd)
+
+
+def initial_guess(total_ligand, y_obs, p_total):
+    '''
+    Finds starting values of Kd, alpha and the scaling factor for fitting the
+    Y-observed by coarse matching against every (Kd, alpha) on the table grid.
+    For each candidate the best scaling follows from linear least squares, and
+    the candidate with the smallest residual is returned.
+    '''
+    table = load_table()
+    log_p, log_alpha = numpy.meshgrid(table.grid[0], table.grid[1], indexing='ij')
+    kd = p_total / numpy.power(10.0, log_p.ravel())[:, numpy.newaxis]
+    alpha = numpy.power(10.0, log_alpha.ravel())[:, numpy.newaxis]
+    model = approx_model_fitting(total_ligand, kd, alpha, p_total)
+    #The optimal scaling of each candidate curve and its squared residual
+    scaling = numpy.sum(model * y_obs, axis=1) / numpy.maximum(numpy.sum(model * model, axis=1), 1e-300)
+    cost = numpy.sum(numpy.power(scaling[:, numpy.newaxis] * model - y_obs, 2.0), axis=1)
+    cost[scaling <= 0] = numpy.inf
+    best = numpy.argmin(cost)
+    return kd[best, 0], alpha[best, 0], scaling[best]
+
+
+def fit_approximate(total_ligand, y_obs, p_total, p0=None):
+    '''
+    Fits Kd, alpha and the scaling factor as fit_lsq does, but to
+    approx_model_fitting, so that no cubic is solved. Kd and alpha are fitted
+    as their logarithms, which keeps them positive; the covariance returned
+    is that of Kd, alpha and the scaling factor. The fit is only as accurate
+    as the table, good for a first look or a start for the exact fit. The
+    optimizer outcome is recorded as by fit_lsq.
+    '''
+    from scipy.optimize import curve_fit
+    if p0 is None:
+        p0 = initial_guess(total_ligand, y_obs, p_total)
+
+    def func(l_total, log_kd, log_alpha, scaling):
+        return scaling * approx_model_fitting(l_total, numpy.power(10.0, log_kd), numpy.power(10.0, log_alpha),
+                                              p_total)
+
+    start = (numpy.log10(p0[0]), numpy.log10(p0[1]), p0[2])
+    if not telemetry.enabled:
+        popt, pcov = curve_fit(func, total_ligand, y_obs, p0=start)
+    else:
+        try:
+            popt, pcov, info, message, status = curve_fit(func, total_ligand, y_obs, p0=start, full_output=True)
+        except RuntimeError as error:
+            telemetry.record('optimizer', {'method': 'lm', 'model': 'approximate', 'converged': False,
+                                           'message': str(error)})
+            raise
+        #Without a Jacobian MINPACK differences the model, so it has no
+        #count of iterations apart from the function evaluations
+        telemetry.record('optimizer', {'method': 'lm', 'model': 'approximate', 'converged': True,
+                                       'status': int(status), 'message': message,
+                                       'function_evaluations': int(info['nfev'])})
+    params = numpy.array([10.0 ** popt[0], 10.0 ** popt[1], popt[2]])
+    #d(10^x)/dx = 10^x ln 10
+    scale = numpy.array([params[0] * numpy.log(10.0), params[1] * numpy.log(10.0), 1.0])
+    return params, pcov * numpy.outer(scale, scale)
+
+
+if __name__ == '__main__':
+    build_table()
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+A Levenberg-Marquardt solver that fits many independent titrations at once.
+The datasets are padded to a common length and stacked, so that the model,
+its Jacobian and every 3x3 normal-equation system are evaluated for all of
+the datasets together in vectorized form rather than one curve_fit at a time.
+"""
+
+import numpy
+
+from ligfit import get_plp_derivatives, solve_species
+
+
+def stack(arrays, fill=None):
+    '''
+    Pads a list of 1-D arrays of differing lengths into one 2-D array. Each
+    row is padded with its own last value unless a fill value is given. Also
+    returns the mask of the real (unpadded) entries.
+    '''
+    length = max(len(i) for i in arrays)
+    stacked = numpy.empty((len(arrays), length))
+    mask = numpy.zeros((len(arrays), length), dtype=bool)
+    for row, values in enumerate(arrays):
+        stacked[row, :len(values)] = values
+        stacked[row, len(values):] = values[-1] if fill is None else fill
+        mask[row, :len(values)] = True
+    return stacked, mask
+
+
+def stacked_model(l_total, params, p_total):
+    '''
+    Returns the scaled [PLP] for stacked ligand concentrations (N, M) and
+    parameter vectors (N, 3) of Kd, alpha and the scaling factor.
+    '''
+    kd, alpha, scaling = [i[:, numpy.newaxis] for i in params.T]
+    plp = solve_species(kd, alpha, p_total, l_total, scratch='stacked_lm')[2]
+    return numpy.nan_to_num(scaling * plp)
+
+
+def stacked_jacobian(l_total, params, p_total):
+    '''
+    Returns the scaled [PLP] and its Jacobian (N, M, 3) with respect to Kd,
+    alpha and the scaling factor for every stacked dataset.
+    '''
+    kd, alpha, scaling = [i[:, numpy.newaxis] for i in params.T]
+    species = solve_species(kd, alpha, p_total, l_total, scratch='stacked_lm')
+    p, plp = species[0], numpy.nan_to_num(species[2])
+    d_kd, d_alpha, d_p_total, d_l_total = get_plp_derivatives(kd, alpha, p_total, l_total, p)
+    jac = numpy.stack(numpy.broadcast_arrays(scaling * d_kd, scaling * d_alpha, plp), axis=-1)
+    return scaling * plp, numpy.nan_to_num(jac)
+
+
+def fit_stacked(l_totals, y_obs, p_total, p0=None, max_iterations=200,
+                ftol=1.49012e-08, xtol=1.49012e-08):
+    '''
+    Fits Kd, alpha and a scaling factor to each of the given datasets (lists
+    of 1-D arrays, which may differ in length) with a Levenberg-Marquardt
+    iteration run on all of them at once. p_total may be a scalar or one value
+    per dataset and p0 may be one starting point or one per dataset.
+
+    All three parameters are stepped in log-space, which keeps them positive
+    and balances parameters spanning many orders of magnitude.
+
+    Returns the optimal parameters (N, 3), their covariances (N, 3, 3), the
+    final sum of squared residuals (N,) and whether each fit converged (N,).
+    '''
+    l_total, mask = stack(l_totals)
+    y, mask = stack(y_obs, fill=0.0)
+    n_sets = l_total.shape[0]
+    p_total = numpy.broadcast_to(numpy.asarray(p_total, numpy.float64), (n_sets,))
+    if p0 is None:
+        p0 = numpy.column_stack((numpy.full(n_sets, 800.0), numpy.full(n_sets, 100.0), 2.0 / p_total))
+    params = numpy.array(numpy.broadcast_to(p0, (n_sets, 3)), numpy.float64)
+    p_total = p_total[:, numpy.newaxis]
+
+    def sum_squares(rows, trial):
+        res = numpy.where(mask[rows], stacked_model(l_total[rows], trial, p_total[rows]) - y[rows], 0.0)
+        return numpy.sum(numpy.power(res, 2.0), axis=1)
+
+    theta = numpy.log(params)
+    cost = sum_squares(slice(None), params)
+    damping = numpy.full(n_sets, 1e-3)
+    growth = numpy.full(n_sets, 2.0)
+    converged = numpy.zeros(n_sets, dtype=bool)
+    active = numpy.arange(n_sets)
+    for iteration in range(max_iterations):
+        if active.size == 0:
+            break
+        current = numpy.exp(theta[active])
+        model, jac = stacked_jacobian(l_total[active], current, p_total[active])
+        #Chain rule into log-space
+        jac = jac * current[:, numpy.newaxis, :]
+        jac = jac * mask[active][..., numpy.newaxis]
+        res = numpy.where(mask[active], model - y[active], 0.0)
+
+        #The damped normal equations of every active dataset, solved together
+        jtj = numpy.einsum('nmi,nmj->nij', jac, jac)
+        grad = numpy.einsum('nmi,nm->ni', jac, res)
+        diagonal = numpy.maximum(numpy.einsum('nii->ni', jtj), 1e-300)
+        lhs = jtj + (damping[active][:, numpy.newaxis] * diagonal)[..., numpy.newaxis] * numpy.eye(3)
+        step = numpy.linalg.solve(lhs, -1.0 * grad[..., numpy.newaxis])[..., 0]
+
+        #Limit each parameter to moving a decade per iteration, a larger jump
+        #along the flat ridges of the surface rarely lands anywhere useful
+        largest = numpy.max(numpy.abs(step), axis=1)
+        step = step * numpy.minimum(1.0, numpy.log(10.0) / numpy.maximum(largest, 1e-300))[:, numpy.newaxis]
+        trial = theta[active] + step
+        with numpy.errstate(all='ignore'):
+            trial_cost = sum_squares(active, numpy.exp(trial))
+        old_cost = cost[active]
+        accepted = numpy.isfinite(trial_cost) & (trial_cost <= old_cost)
+
+        #Gain ratio of the actual to the predicted decrease (Nielsen's update)
+        predicted = numpy.einsum('ni,ni->n', step, damping[active][:, numpy.newaxis] * diagonal * step - grad)
+        with numpy.errstate(all='ignore'):
+            gain = (old_cost - trial_cost) / predicted
+        shrink = numpy.maximum(1.0 / 3.0, 1.0 - numpy.power(2.0 * numpy.nan_to_num(gain) - 1.0, 3.0))
+        damping[active] = numpy.where(accepted, damping[active] * shrink, damping[active] * growth[active])
+        growth[active] = numpy.where(accepted, 2.0, growth[active] * 2.0)
+
+        relative_decrease = (old_cost - trial_cost) / numpy.maximum(old_cost, 1e-300)
+        relative_step = numpy.max(numpy.abs(step) / (numpy.abs(theta[active]) + xtol), axis=1)
+        theta[active[accepted]] = trial[accepted]
+        cost[active[accepted]] = trial_cost[accepted]
+
+        #A damping that has grown without bound means no step can decrease
+        #the cost any further, i.e. a minimum to within rounding
+        done = (accepted & ((relative_decrease < ftol) | (relative_step < xtol))) | (damping[active] > 1e16)
+        converged[active[done]] = True
+        active = active[~done]
+
+    #Covariance as curve_fit reports it, scaled by the residual variance
+    params = numpy.exp(theta)
+    model, jac = stacked_jacobian(l_total, params, p_total)
+    jac = jac * mask[..., numpy.newaxis]
+    jtj = numpy.einsum('nmi,nmj->nij', jac, jac)
+    dof = numpy.maximum(mask.sum(axis=1) - 3, 1)
+    pcov = numpy.linalg.pinv(jtj) * (cost / dof)[:, numpy.newaxis, numpy.newaxis]
+    return params, pcov, cost, converged
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Starting values of Kd, alpha and the scaling factor for fitting, estimated
+from the shape of the observed signal before the optimizer starts.
+
+[PLP] peaks where L_total = (Kd + P_total)/2 (max_plp in the resources
+scripts), so an observed maximum within the titration gives Kd directly.
+While the dimer is far from saturating the protein, the curve rises to half
+its peak at 3 - 2*sqrt(2) and falls back to half at 3 + 2*sqrt(2) times Kd/2,
+which give Kd from the half-rise and half-fall points when the peak itself
+lies at the edge of the data. Alpha changes the shape of the rise rather than
+where it lies, so it is chosen, together with the closed-form optimal
+scaling, by the smallest residual over a coarse log grid about each Kd.
+Where the data shows neither its maximum nor a half-rise or half-fall, the
+best match against the precomputed table of solution_table.py gives Kd (and
+a candidate alpha) instead.
+"""
+
+import numpy
+
+from ligfit import solve_species
+
+#Half-rise position relative to Kd/2; its reciprocal gives the half-fall
+HALF_RISE = 3.0 - 2.0 * numpy.sqrt(2.0)
+
+#Grids about each estimate of Kd (in decades) and of log10 alpha
+LOG_KD_SPREAD = numpy.linspace(-1.0, 1.0, 5)
+LOG_ALPHA = numpy.linspace(-2.0, 10.0, 49)
+
+
+def header_guess(parameters):
+    '''
+    Returns the Kd and alpha guesses written by makeinput into the JSON
+    header of an input file, or None if it has none.
+    '''
+    if 'init_kd' in parameters and 'init_alpha' in parameters:
+        return float(parameters['init_kd']), float(parameters['init_alpha'])
+    return None
+
+
+def running_median(y):
+    '''
+    Median of each point and its two neighbours, so that a single noisy
+    point is not taken for the maximum.
+    '''
+    if len(y) < 3:
+        return y
+    padded = numpy.concatenate((y[:1], y, y[-1:]))
+    return numpy.median(numpy.stack((padded[:-2], padded[1:-1], padded[2:])), axis=0)
+
+
+def crossing(l_total, y, level):
+    '''
+    Returns where y first reaches the level, interpolating linearly in log
+    L_total between the points either side.
+    '''
+    i = numpy.argmax(y >= level)
+    if i == 0:
+        return l_total[0]
+    fraction = (level - y[i - 1]) / (y[i] - y[i - 1])
+    return numpy.exp(numpy.log(l_total[i - 1]) + fraction * numpy.log(l_total[i] / l_total[i - 1]))
+
+
+def kd_estimates(total_ligand, y_obs, p_total):
+    '''
+    Returns the estimates of Kd given by the observed maximum of the signal
+    and by its half-rise and half-fall points, whichever the data covers,
+    which may be none.
+    '''
+    order = numpy.argsort(total_ligand)
+    l_total = total_ligand[order]
+    y = running_median(y_obs[order])
+    peak = numpy.argmax(y)
+    half = 0.5 * y[peak]
+    estimates = []
+    #A maximum at the first point only bounds Kd from above, so it is left
+    #to the half-fall; at the last point it bounds it from below
+    if peak > 0:
+        estimates.append(2.0 * l_total[peak] - p_total)
+    if y[:peak].size and y[:peak].min() <= half:
+        estimates.append(2.0 * crossing(l_total, y, half) / HALF_RISE)
+    if y[peak + 1:].size and y[peak + 1:].min() <= half:
+        estimates.append(2.0 * HALF_RISE * crossing(l_total[peak:][::-1], y[peak:][::-1], half))
+    return [i for i in estimates if i > 0]
+
+
+def estimate_start(total_ligand, y_obs, p_total, guess=None):
+    '''
+    Returns starting values of Kd, alpha and the scaling factor for fitting
+    the Y-observed. Each candidate Kd and alpha is scored by its residual at
+    its optimal scaling, and the Kd and alpha of a guess, such as the one in
+    the input file header, compete with the estimates.
+    '''
+    estimates = kd_estimates(total_ligand, y_obs, p_total)
+    candidates = [] if guess is None else [guess]
+    if not estimates:
+        from solution_table import initial_guess
+        table_kd, table_alpha, table_scaling = initial_guess(total_ligand, y_obs, p_total)
+        estimates = [table_kd]
+        candidates.append((table_kd, table_alpha))
+    kd = numpy.outer(estimates, numpy.power(10.0, LOG_KD_SPREAD))
+    kd, alpha = [i.ravel() for i in numpy.meshgrid(kd.ravel(), numpy.power(10.0, LOG_ALPHA), indexing='ij')]
+    for candidate in candidates:
+        kd = numpy.append(kd, candidate[0])
+        alpha = numpy.append(alpha, candidate[1])
+    kd = kd[:, numpy.newaxis]
+    alpha = alpha[:, numpy.newaxis]
+    model = numpy.nan_to_num(solve_species(kd, alpha, p_total, total_ligand)[2])
+    #The optimal scaling of each candidate curve and its squared residual
+    scaling = numpy.sum(model * y_obs, axis=1) / numpy.maximum(numpy.sum(model * model, axis=1), 1e-300)
+    cost = numpy.sum(numpy.power(scaling[:, numpy.newaxis] * model - y_obs, 2.0), axis=1)
+    cost[scaling <= 0] = numpy.inf
+    best = numpy.argmin(cost)
+    return kd[best, 0], alpha[best, 0], scaling[best]
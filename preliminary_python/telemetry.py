@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Opt-in instrumentation of the model and fitting code. While it is enabled,
+the instrumented functions count their calls and time spent, the cubic
+solver counts the points taking each branch, free_protein counts the points
+escalated to each precision, and the fits record their optimizer iterations
+and termination reason. The compiled kernel counts its branches like the
+cubic solver, but is timed as one stage, compiled_species. All of it is
+gathered into a report that converts straight to JSON.
+
+While disabled the cost is a single flag test per instrumented call.
+"""
+
+import contextlib
+import functools
+import time
+
+enabled = False
+
+_counters = {}
+_timers = {}
+_records = {}
+
+
+def enable():
+    global enabled
+    enabled = True
+
+
+def disable():
+    global enabled
+    enabled = False
+
+
+def reset():
+    _counters.clear()
+    _timers.clear()
+    _records.clear()
+
+
+@contextlib.contextmanager
+def collect():
+    '''
+    Enables the instrumentation, starting from zero, for the duration of a
+    with block.
+    '''
+    reset()
+    enable()
+    try:
+        yield
+    finally:
+        disable()
+
+
+def count(name, n=1):
+    '''
+    Adds n to a counter; the callers test enabled first.
+    '''
+    _counters[name] = _counters.get(name, 0) + int(n)
+
+
+def record(name, value):
+    '''
+    Stores a value (such as the outcome of an optimizer) under a name,
+    replacing any earlier one.
+    '''
+    _records[name] = value
+
+
+def timed(name):
+    '''
+    Decorator counting the calls of a function and the time spent in them,
+    under the given name, while the instrumentation is enabled.
+    '''
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                calls, seconds = _timers.get(name, (0, 0.0))
+                _timers[name] = (calls + 1, seconds + time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+def report():
+    '''
+    Returns everything gathered so far as a dict of plain values: the
+    counters, the calls and seconds of each timed function, and the records.
+    '''
+    timers = dict((name, {'calls': calls, 'seconds': seconds}) for name, (calls, seconds) in _timers.items())
+    return {'counters': dict(_counters), 'timers': timers, 'records': dict(_records)}
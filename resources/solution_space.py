@@ -42,10 +42,12 @@ def cartesian_cubic(a, q, r):
     The cartesian coordinate solution of the cubic function; for use when
     Q^3+R^2 > 0
     '''
-    #Calculate the three terms of the cubic
+    #Calculate the three terms of the cubic, the real cube root is required as
+    #R - sqrt(Q^3 + R^2) is negative whenever Q > 0
+    root = numpy.sqrt(numpy.power(q, 3.0) + numpy.power(r, 2.0))
     first = a / -3.0
-    second = numpy.power(r + numpy.sqrt(numpy.power(q, 3) + numpy.power(r, 2)), 1.0 / 3.0)
-    third = numpy.power(r - numpy.sqrt(numpy.power(q, 3) + numpy.power(r, 2)), 1.0 / 3.0)
+    second = numpy.cbrt(r + root)
+    third = numpy.cbrt(r - root)
     return first + second + third
 
 
@@ -54,11 +56,29 @@ def polar_cubic(a, q, r):
     The polar coordinate solution of the cubic function; for use when
     Q^3+R^2 < 0
     '''
-    theta = numpy.arccos(r / numpy.sqrt(-1.0 * numpy.power(q, 3.0)))
+    #Rounding may push the cosine argument just outside of [-1, 1]
+    cos_theta = numpy.clip(r / numpy.sqrt(-1.0 * numpy.power(q, 3.0)), -1.0, 1.0)
+    theta = numpy.arccos(cos_theta)
     val = numpy.cos(theta / 3.0) * numpy.sqrt(-1.0 * q) * 2.0 - a / 3.0
     return val
 
 
+def solve_cubic(a, q, r):
+    '''
+    Solves the cubic for [P]-free over whole arrays at once. The discriminant
+    Q^3+R^2 is computed a single time and each of the cartesian and polar
+    solutions is evaluated only on the points selected by its mask.
+    '''
+    a, q, r = numpy.broadcast_arrays(a, q, r)
+    disc = numpy.power(q, 3.0) + numpy.power(r, 2.0)
+    cartesian = disc > 0
+    polar = ~cartesian
+    p = numpy.empty_like(disc)
+    p[cartesian] = cartesian_cubic(a[cartesian], q[cartesian], r[cartesian])
+    p[polar] = polar_cubic(a[polar], q[polar], r[polar])
+    return p
+
+
 def get_pl(kd, alpha, l_total, p):
     '''
     After solving for [P]-free, this function will return the concentration of
@@ -81,13 +101,7 @@ def get_plp(kd, alpha, l_total, p):
 def model_func(kd, alpha, p_total, l_total):
     a, b, c = calc_abc(kd, alpha, p_total, l_total)
     q, r = calc_qr(a, b, c)
-    p = []
-    for a_val, q_val, r_val in zip(a, q, r):
-        if numpy.power(q_val, 3.0) + numpy.power(r_val, 2.0) > 0:
-            p.append(cartesian_cubic(a_val, q_val, r_val))
-        else:
-            p.append(polar_cubic(a_val, q_val, r_val))
-    p = numpy.array(p)
+    p = solve_cubic(a, q, r)
     #pl = get_pl(kd, alpha, l_total, p)
     plp = get_plp(kd, alpha, l_total, p)
     #All we care about here is PLP
@@ -108,13 +122,9 @@ kd = 1.0
 l_total = numpy.logspace(-2, 3.5, 100).astype('float128')
 alpha = numpy.logspace(-2, 8, 100).astype('float128')
 
-#I considered using meshgrid here, but was confounded by the "polar or cubic"
-#operation, so I went for a bit less elegance
-plp_concentration = []
-for alpha_value in alpha:
-    plp = model_func(kd, alpha_value, p_total, l_total)
-    plp_concentration.append(plp)
-plp_soln = numpy.array(plp_concentration)
+#The cubic solver is fully vectorized, so the whole alpha by l_total grid is
+#solved at once by broadcasting alpha down the rows
+plp_soln = model_func(kd, alpha[:, numpy.newaxis], p_total, l_total)
 
 
 lm, am = numpy.meshgrid(l_total, alpha)